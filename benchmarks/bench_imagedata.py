@@ -0,0 +1,91 @@
+# bench_imagedata.py
+# compare ImageData access paths used by Mango.read_datafile
+#
+# Usage:
+#   python benchmarks/bench_imagedata.py [--frames N] [--size PIXELS]
+#   (with mangopy installed, e.g. pip install -e .)
+#
+# - writes a contiguous (uncompressed) and a chunked, gzip compressed data file
+#   to a temporary directory, then times reading every frame in order with the
+#   access path chosen by Mango.image_access and with plain h5py reads using
+#   the hdf5 library's default 1 MB chunk cache
+
+import argparse
+import datetime as dt
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from mangopy import Mango
+
+
+def write_datafile(filename, frames, size, chunked):
+    # write a data file with the layout read by Mango.read_datafile
+    start = (dt.datetime(2017,5,28,3,0)-dt.datetime.utcfromtimestamp(0)).total_seconds()
+    lat, lon = np.meshgrid(np.linspace(35.,45.,size), np.linspace(240.,255.,size), indexing='ij')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('Time', data=start+np.arange(frames)*300.)
+        f.create_dataset('Latitude', data=lat)
+        f.create_dataset('Longitude', data=lon)
+        images = np.random.randint(0, 4096, size=(frames,size,size)).astype(np.uint16)
+        if chunked:
+            f.create_dataset('ImageData', data=images, chunks=(8,size,size), compression='gzip')
+        else:
+            f.create_dataset('ImageData', data=images)
+    return [dt.datetime.utcfromtimestamp(t) for t in start+np.arange(frames)*300.]
+
+
+def plain_access(filename, entry):
+    # open ImageData with the hdf5 library's default chunk cache instead of Mango.image_access
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(521, 1024**2, 0.75)
+    entry['images'] = h5py.Dataset(h5py.h5d.open(entry['file'].id, b'ImageData', dapl))
+
+
+def time_reads(m, filename, times, repeat=3):
+    # best time (s) to read every frame in order with read_datafile
+    best = np.inf
+    for __ in range(repeat):
+        m.close()
+        t0 = time.perf_counter()
+        for t in times:
+            np.asarray(m.read_datafile(filename, t)[0]).sum()
+        best = min(best, time.perf_counter()-t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare ImageData access paths')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--size', type=int, default=512)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for chunked in [False, True]:
+            filename = os.path.join(tmpdir, 'chunked.h5' if chunked else 'contiguous.h5')
+            times = write_datafile(filename, args.frames, args.size, chunked)
+
+            fast = Mango(datadir=tmpdir)
+            images = fast.open_datafile(filename)['images']
+            path = 'memmap' if isinstance(images, np.ndarray) else 'h5py (chunk cache {} bytes)'.format(images.id.get_access_plist().get_chunk_cache()[1])
+            fast_time = time_reads(fast, filename, times)
+            # hdf5 shares open datasets, so close the file before reopening it
+            del images
+            fast.close()
+
+            # plain h5py reads with the hdf5 library's default 1 MB chunk cache
+            plain = Mango(datadir=tmpdir, use_memmap=False)
+            plain.image_access = plain_access
+            plain_time = time_reads(plain, filename, times)
+
+            plain.close()
+
+            print('{:10s} {:40s} {:8.2f} ms/frame   h5py {:8.2f} ms/frame'.format(
+                'chunked' if chunked else 'contiguous', path, fast_time/len(times)*1e3, plain_time/len(times)*1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# bench_import.py
+# check that importing mangopy stays fast
+#
+# Usage:
+#   python benchmarks/bench_import.py [--repeat N] [--budget MS]
+#   (with mangopy installed, e.g. pip install -e .)
+#
+# - imports mangopy in fresh interpreters with python -X importtime and reports the
+#   median time spent importing it, beyond the numpy and h5py it always needs
+# - exits with status 1 if that time is over budget, or if importing mangopy loads
+#   any of the plotting or regridding dependencies, which should only be imported
+#   by the methods that use them
+
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+
+# modules that must not be imported by import mangopy
+LAZY_MODULES = ['matplotlib', 'cartopy', 'scipy', 'future']
+
+
+def import_time(statement):
+    # cumulative import time (s) of each top-level module imported by statement, in a fresh interpreter
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        __, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented under the module that imported them
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative)*1e-6
+    return times
+
+
+def loaded_modules(statement):
+    # top-level names of all modules loaded by statement, in a fresh interpreter
+    check = '{}; import sys; print(" ".join(sorted(set(m.split(".")[0] for m in sys.modules))))'.format(statement)
+    result = subprocess.run([sys.executable, '-c', check], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of mangopy')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh imports')
+    parser.add_argument('--budget', type=float, default=100., help='budget (ms) for mangopy beyond numpy and h5py')
+    args = parser.parse_args()
+
+    baseline = []
+    total = []
+    for __ in range(args.repeat):
+        times = import_time('import numpy, h5py')
+        baseline.append(times['numpy']+times['h5py'])
+        total.append(import_time('import mangopy')['mangopy'])
+
+    own = np.median(total)-np.median(baseline)
+    print('numpy + h5py    {:8.1f} ms'.format(np.median(baseline)*1e3))
+    print('import mangopy  {:8.1f} ms'.format(np.median(total)*1e3))
+    print('mangopy itself  {:8.1f} ms (budget {:.0f} ms)'.format(own*1e3, args.budget))
+
+    failed = False
+    if own*1e3 > args.budget:
+        print('FAILED: import time is over budget')
+        failed = True
+
+    eager = sorted(set(LAZY_MODULES) & set(loaded_modules('import mangopy')))
+    if eager:
+        print('FAILED: import mangopy loads {}'.format(', '.join(eager)))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# bench_pipeline.py
+# benchmark the get_data -> regrid -> mosaic hot path on synthetic MANGO data
+#
+# Usage:
+#   python benchmarks/bench_pipeline.py [--frames N] [--size PIXELS]
+#                                       [--resolutions 4,2,1] [--sites 2,5,9]
+#   (with mangopy installed, e.g. pip install -e .)
+#
+# - synthetic data files for every site in SiteInformation.csv are written to a
+#   temporary directory (see synthetic.py)
+# - each stage is timed for every combination of grid resolution (as a multiple
+#   of the default 0.02 x 0.03 degree grid spacing) and number of sites, and the
+#   peak memory allocated during the stage is recorded with tracemalloc
+# - every combination uses an empty regrid cache, so get_nearest_index is timed
+#   both cold (calculated) and warm (loaded from the cache)
+
+import argparse
+import datetime as dt
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from mangopy import Mosaic, GridSpec
+import synthetic
+
+
+def measure(func, *args, **kwargs):
+    # run func once, returning its result, wall time (s) and peak memory allocated (bytes)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter()-t0
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def repeat(func, args_list):
+    # call func for each set of arguments without keeping the results
+    for args in args_list:
+        func(*args)
+
+
+def report(resolution, nsites, stage, elapsed, peak):
+    print('{:>10} {:>6d} {:24s} {:10.1f} ms {:10.1f} MB'.format(resolution, nsites, stage, elapsed*1e3, peak/1024.**2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MANGO mosaic pipeline')
+    parser.add_argument('--frames', type=int, default=12, help='images per site')
+    parser.add_argument('--size', type=int, default=519, help='image rows and columns')
+    parser.add_argument('--resolutions', default='4,2,1', help='grid spacing multipliers')
+    parser.add_argument('--sites', default='2,5,9', help='numbers of sites')
+    args = parser.parse_args()
+
+    resolutions = [float(r) for r in args.resolutions.split(',')]
+    site_counts = [int(n) for n in args.sites.split(',')]
+    date = dt.date(2017,5,28)
+    starttime = dt.datetime.combine(date,dt.time(2,0))
+    times = [starttime+dt.timedelta(minutes=5*i) for i in range(args.frames)]
+
+    with tempfile.TemporaryDirectory() as datadir:
+        site_list = synthetic.create_dataset(datadir, date, frames=args.frames, size=args.size)
+
+        print('{:>10} {:>6} {:24s} {:>13} {:>13}'.format('resolution', 'sites', 'stage', 'time', 'peak memory'))
+        for resolution in resolutions:
+            for nsites in site_counts:
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    grid_spec = GridSpec(latstp=0.02*resolution, lonstp=0.03*resolution)
+                    m = Mosaic(datadir=datadir, cache_dir=cache_dir, grid_spec=grid_spec)
+                    m.site_list = site_list[:nsites]
+                    site = m.site_list[0]
+
+                    filename = m.datafile_name(site,date)
+                    __, elapsed, peak = measure(repeat, m.read_datafile, [(filename,t) for t in times])
+                    report(resolution, nsites, 'read_datafile (/frame)', elapsed/len(times), peak)
+
+                    grid, __, __ = measure(lambda: m.grid)
+                    __, elapsed, peak = measure(m.get_nearest_index, site, grid, times[0])
+                    report(resolution, nsites, 'get_nearest_index cold', elapsed, peak)
+                    __, elapsed, peak = measure(m.get_nearest_index, site, grid, times[0])
+                    report(resolution, nsites, 'get_nearest_index warm', elapsed, peak)
+
+                    hierarchy, elapsed, peak = measure(m.site_hierarchy, grid)
+                    report(resolution, nsites, 'site_hierarchy', elapsed, peak)
+                    m._hierarchy = hierarchy
+
+                    # the first frame also calculates regrid indices and the gather plan
+                    __, elapsed, peak = measure(m.grid_mosaic, times[0], grid, hierarchy)
+                    report(resolution, nsites, 'grid_mosaic first', elapsed, peak)
+                    __, elapsed, peak = measure(repeat, m.grid_mosaic, [(t,grid,hierarchy) for t in times[1:]])
+                    report(resolution, nsites, 'grid_mosaic (/frame)', elapsed/max(len(times)-1,1), peak)
+
+                    __, elapsed, peak = measure(m.create_mosaic, times[-1])
+                    report(resolution, nsites, 'create_mosaic', elapsed, peak)
+                    m.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# synthetic.py
+# synthetic MANGO data files for benchmarks
+#
+# - files have the layout read by Mango.read_datafile (Time, ImageData, Latitude, Longitude)
+#   and are written to DATADIR/SITE NAME/MMMDDYY/CMMMDDYY.h5 like downloaded data
+# - Latitude/Longitude follow an all-sky camera with an equidistant fisheye lens looking at
+#   an airglow layer at 250 km, so fields of view are realistic in size and overlap
+
+import datetime as dt
+import os
+
+import h5py
+import numpy as np
+
+from mangopy import Mango
+
+
+def camera_coordinates(site, size=519, height=250., max_zenith=75.):
+    """
+    Latitude and longitude of each camera pixel projected to the airglow layer.
+
+    Parameters
+    ==========
+    site : dict
+        Site information, as returned by Mango.get_site_info.
+    size : int, optional
+        Number of image rows and columns.
+    height : float, optional
+        Height of airglow layer in km.
+    max_zenith : float, optional
+        Zenith angle (degrees) beyond which pixels are NaN.
+
+    Returns
+    =======
+    lat : array
+        Latitude array
+    lon : array
+        Longitude array (0-360 degrees)
+
+    """
+    Re = 6371.
+    y, x = np.mgrid[0:size,0:size]-(size-1)/2.
+    zenith = np.hypot(x,y)/(size/2.)*np.pi/2.
+    azimuth = np.arctan2(x,-y)
+
+    # angle at the center of the earth between the site and the point on the airglow layer
+    alpha = zenith-np.arcsin(Re/(Re+height)*np.sin(zenith))
+
+    lat0 = np.radians(site['lat'])
+    lon0 = np.radians(site['lon'])
+    lat = np.arcsin(np.sin(lat0)*np.cos(alpha)+np.cos(lat0)*np.sin(alpha)*np.cos(azimuth))
+    lon = lon0+np.arctan2(np.sin(azimuth)*np.sin(alpha)*np.cos(lat0), np.cos(alpha)-np.sin(lat0)*np.sin(lat))
+
+    lat = np.degrees(lat)
+    lon = np.degrees(lon)%360.
+    outside = zenith>np.radians(max_zenith)
+    lat[outside] = np.nan
+    lon[outside] = np.nan
+    return lat, lon
+
+
+def write_datafile(filename, site, date, frames=109, size=519, start=dt.time(2,0), cadence=5., chunked=False, seed=0):
+    """
+    Writes a synthetic daily data file for one site.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 filename
+    site : dict
+        Site information, as returned by Mango.get_site_info.
+    date : datetime object
+        Date of data file.
+    frames : int, optional
+        Number of images.
+    size : int, optional
+        Number of image rows and columns.
+    start : time object, optional
+        Time of first image.
+    cadence : float, optional
+        Time between images in minutes.
+    chunked : bool, optional
+        If True, ImageData is chunked by frame and gzip compressed.
+    seed : int, optional
+        Random seed for image data.
+
+    Returns
+    =======
+    times : list
+        Times of images.
+
+    """
+    rng = np.random.default_rng(seed)
+    start = (dt.datetime.combine(date,start)-dt.datetime.utcfromtimestamp(0)).total_seconds()
+    # cameras aren't synchronized, so offset every site by a few seconds
+    tstmp = start+np.arange(frames)*cadence*60.+rng.uniform(0.,30.)
+    lat, lon = camera_coordinates(site, size=size)
+
+    if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('Time', data=tstmp)
+        f.create_dataset('Latitude', data=lat)
+        f.create_dataset('Longitude', data=lon)
+        images = f.create_dataset('ImageData', shape=(frames,size,size), dtype=np.uint16,
+                                  chunks=(1,size,size) if chunked else None, compression='gzip' if chunked else None)
+        for i in range(frames):
+            images[i] = rng.integers(0, 4096, size=(size,size), dtype=np.uint16)
+
+    return [dt.datetime.utcfromtimestamp(t) for t in tstmp]
+
+
+def create_dataset(datadir, date, sites='all', **kwargs):
+    """
+    Writes synthetic daily data files for several sites in the directory
+    layout used by Mango.get_data.
+
+    Parameters
+    ==========
+    datadir : str
+        Data directory.
+    date : datetime object
+        Date of data files.
+    sites : list, optional
+        Sites to write files for.  Defaults to all sites in SiteInformation.csv.
+    kwargs
+        Passed on to write_datafile.
+
+    Returns
+    =======
+    site_list : list
+        List of dictionaries with information about sites.
+
+    """
+    m = Mango(datadir=datadir)
+    site_list = m.sites.select(sites)
+    for i, site in enumerate(site_list):
+        write_datafile(m.datafile_name(site,date), site, date, seed=i, **kwargs)
+    return site_list
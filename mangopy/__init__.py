@@ -1,2 +1,5 @@
 from .mango import Mango
 from .mosaic import Mosaic
+from .grid import GridSpec
+from .sites import SiteRegistry
+from .instrument import Profiler
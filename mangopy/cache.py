@@ -0,0 +1,223 @@
+# cache.py
+# on-disk cache for regridding indices and site hierarchies
+#
+# Notes:
+# - Default cache directory is TEMP/MANGOCache-USER/, where TEMP is defined by tempfile.gettempdir()
+#   and USER is the user name, unless the MANGOPY_CACHE_DIR environment variable is set
+# - if the cache directory can't be written, arrays are calculated every time they are needed
+# - each entry is a separate hdf5 file named by a hash of everything it was calculated from,
+#   so changing the grid or a camera's calibration never reuses stale entries
+# - entries are written to a temporary file and renamed while holding a lock file, so several
+#   processes can safely share one cache directory
+
+import numpy as np
+import h5py
+import os
+import re
+import hashlib
+import tempfile
+import getpass
+try:
+    import fcntl
+except ImportError:
+    # file locking is not available on Windows; atomic renames still keep entries intact
+    fcntl = None
+from . import instrument
+
+
+# increment when the contents of cache entries change
+CACHE_VERSION = 2
+
+
+class RegridCache(object):
+    """
+    Cache of arrays that are expensive to calculate but only depend on the
+    mosaic geometry, such as regridding indices and site hierarchies.
+
+    Parameters
+    ==========
+    cache_dir : str, optional
+        Path to directory where cache files are stored.
+
+    """
+
+    def __init__(self, cache_dir=None):
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('MANGOPY_CACHE_DIR', default_cache_dir())
+        self.cache_dir = cache_dir
+
+
+    def key(self, *parts):
+        """
+        Creates a cache key from everything a cached array depends on.
+
+        Parameters
+        ==========
+        parts : arrays, str or float
+            Values the cached array was calculated from.
+
+        Returns
+        =======
+        key : str
+            Hexadecimal hash of all parts.
+
+        """
+        key = hashlib.sha1('v{}'.format(CACHE_VERSION).encode())
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                key.update('{}{}'.format(part.dtype.str,part.shape).encode())
+                key.update(np.ascontiguousarray(part).tobytes())
+            else:
+                key.update(repr(part).encode())
+            key.update(b';')
+        return key.hexdigest()
+
+
+    def filename(self, name, key):
+        """
+        Path of a cache entry.
+
+        Parameters
+        ==========
+        name : str
+            Name of the cached quantity (e.g. site name).
+        key : str
+            Cache key.
+
+        Returns
+        =======
+        filename : str
+            Path to hdf5 file for this entry.
+
+        """
+        name = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+        return os.path.join(self.cache_dir, '{}_{}.h5'.format(name, key))
+
+
+    def load(self, name, key):
+        """
+        Loads a cached array.
+
+        Parameters
+        ==========
+        name : str
+            Name of the cached quantity.
+        key : str
+            Cache key.
+
+        Returns
+        =======
+        data : array or None
+            Cached array, or None if it is not in the cache.
+
+        """
+        try:
+            with h5py.File(self.filename(name, key), 'r') as f:
+                return f['data'][:]
+        except (OSError, IOError, KeyError):
+            return None
+
+
+    def save(self, name, key, data):
+        """
+        Saves an array to the cache.  The array is written to a temporary file
+        which is then renamed, so readers never see a partially written entry.
+
+        Parameters
+        ==========
+        name : str
+            Name of the cached quantity.
+        key : str
+            Cache key.
+        data : array
+            Array to be cached.
+
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            with h5py.File(tmpname, 'w') as f:
+                f.create_dataset('data', data=data, compression='gzip', compression_opts=1)
+            os.replace(tmpname, self.filename(name, key))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+
+    def get(self, name, key, calculate):
+        """
+        Loads a cached array, calculating and saving it first if necessary.  A
+        lock file makes sure only one process calculates a missing entry while
+        other processes wait for it.  If the cache directory can't be written,
+        the array is calculated but not saved.
+
+        Parameters
+        ==========
+        name : str
+            Name of the cached quantity.
+        key : str
+            Cache key.
+        calculate : function
+            Function with no arguments that returns the array if it is not cached.
+
+        Returns
+        =======
+        data : array
+            Cached array.
+
+        """
+        data = self.load(name, key)
+        if data is not None:
+            instrument.count('regrid_cache_hits', site=name)
+            return data
+        instrument.count('regrid_cache_misses', site=name)
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            lock = open(self.filename(name, key)+'.lock', 'w')
+        except (OSError, IOError) as e:
+            print('Unable to use cache directory {}: {}'.format(self.cache_dir, str(e)))
+            return calculate()
+
+        with lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have created the entry while we waited for the lock
+                data = self.load(name, key)
+                if data is None:
+                    data = calculate()
+                    try:
+                        self.save(name, key, data)
+                    except (OSError, IOError) as e:
+                        # the array can still be used, it just isn't saved
+                        print('Unable to save {} to cache directory {}: {}'.format(name, self.cache_dir, str(e)))
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return data
+
+
+def default_cache_dir():
+    """
+    Default cache directory, which is separate for each user so users don't
+    need to write to each other's cache files.
+
+    Returns
+    =======
+    cache_dir : str
+        Path to cache directory.
+
+    """
+    try:
+        user = getpass.getuser()
+    except (KeyError, OSError, ImportError):
+        # no user name in the environment or password database
+        user = str(os.getuid()) if hasattr(os, 'getuid') else 'default'
+    return os.path.join(tempfile.gettempdir(), 'MANGOCache-{}'.format(re.sub(r'[^A-Za-z0-9_-]+', '_', user)))
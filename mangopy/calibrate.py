@@ -0,0 +1,165 @@
+# calibrate.py
+# per-site, per-night background and scale calibration of MANGO images
+#
+# Notes:
+# - the background and scale of each pixel are its mean and standard deviation over the
+#   whole night, calculated by streaming over ImageData a few frames at a time
+# - calibrated images are (image-background)/scale, so images of cameras with different
+#   gains and sky backgrounds can be compared (and mosaicked) directly
+# - calibrations are saved next to the data file (<data file>_calibration.h5) and are
+#   recalculated when the data file changes
+
+import numpy as np
+import h5py
+import os
+import tempfile
+from . import instrument
+
+
+# increment when the calculation of calibrations changes
+CALIBRATION_VERSION = 1
+
+
+@instrument.timed('night_statistics')
+def night_statistics(images, frames_per_read=16):
+    """
+    Mean and standard deviation of every pixel over a night of images,
+    ignoring NaNs.  Only frames_per_read frames are held in memory at a time;
+    the statistics of each block of frames are merged into running totals
+    (Chan et al.'s parallel variance algorithm).
+
+    Parameters
+    ==========
+    images : h5py dataset or array
+        Images with shape (frames, rows, columns).
+    frames_per_read : int, optional
+        Number of frames read at once.
+
+    Returns
+    =======
+    mean : array
+        Mean of each pixel (NaN for pixels without data).
+    std : array
+        Standard deviation of each pixel (NaN for pixels without data).
+    count : array
+        Number of frames with data for each pixel.
+
+    """
+    shape = images.shape[1:]
+    count = np.zeros(shape)
+    mean = np.zeros(shape)
+    m2 = np.zeros(shape)
+
+    frames_per_read = max(int(frames_per_read),1)
+    buffer = np.empty((frames_per_read,)+shape, dtype=images.dtype)
+    for start in range(0, images.shape[0], frames_per_read):
+        stop = min(start+frames_per_read, images.shape[0])
+        block = buffer[:stop-start]
+        if isinstance(images, np.ndarray):
+            block[...] = images[start:stop]
+        else:
+            images.read_direct(block, np.s_[start:stop], np.s_[0:stop-start])
+        instrument.count('hdf5_bytes_read', block.nbytes)
+
+        # statistics of this block of frames
+        valid = np.isfinite(block)
+        n = valid.sum(axis=0).astype(float)
+        values = np.where(valid, block, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_mean = values.sum(axis=0)/n
+        block_m2 = (np.where(valid, values-block_mean, 0.)**2).sum(axis=0)
+
+        # merge with the frames before it
+        total = count+n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(n>0, block_mean-mean, 0.)
+            mean += np.where(total>0, delta*n/total, 0.)
+            m2 += np.where(n>0, block_m2+delta**2*count*n/total, 0.)
+        count = total
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count>0, mean, np.nan)
+        std = np.where(count>0, np.sqrt(m2/count), np.nan)
+    return mean, std, count
+
+
+def calibration_filename(filename):
+    """
+    Path of the calibration of a data file.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 data filename
+
+    Returns
+    =======
+    filename : str
+        hdf5 calibration filename
+
+    """
+    return os.path.splitext(filename)[0]+'_calibration.h5'
+
+
+def load_calibration(filename, mtime):
+    """
+    Loads the calibration of a data file, if it was calculated from the
+    current version of the data file.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 data filename
+    mtime : float
+        Modification time of the data file.
+
+    Returns
+    =======
+    background : array or None
+        Background of each pixel, or None if there is no valid calibration.
+    scale : array or None
+        Scale of each pixel.
+
+    """
+    try:
+        with h5py.File(calibration_filename(filename), 'r') as f:
+            if f.attrs['version'] != CALIBRATION_VERSION or f.attrs['source_mtime'] != mtime:
+                return None, None
+            return f['Background'][:], f['Scale'][:]
+    except (OSError, IOError, KeyError):
+        return None, None
+
+
+def save_calibration(filename, mtime, background, scale, count):
+    """
+    Saves the calibration of a data file next to it.  The calibration is
+    written to a temporary file which is then renamed, so readers never see
+    a partially written file.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 data filename
+    mtime : float
+        Modification time of the data file.
+    background : array
+        Background of each pixel.
+    scale : array
+        Scale of each pixel.
+    count : array
+        Number of frames each pixel's calibration is based on.
+
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    os.close(fd)
+    try:
+        with h5py.File(tmpname, 'w') as f:
+            f.attrs['version'] = CALIBRATION_VERSION
+            f.attrs['source_mtime'] = mtime
+            f.create_dataset('Background', data=background, compression='gzip', compression_opts=1)
+            f.create_dataset('Scale', data=scale, compression='gzip', compression_opts=1)
+            f.create_dataset('Count', data=count.astype(np.int32), compression='gzip', compression_opts=1)
+        os.replace(tmpname, calibration_filename(filename))
+    except BaseException:
+        os.remove(tmpname)
+        raise
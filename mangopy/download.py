@@ -0,0 +1,153 @@
+# download.py
+# FTP download utilities for MANGO data files
+#
+# Notes:
+# - files are downloaded to FILENAME.part and only renamed to FILENAME once their size
+#   matches the size reported by the server, so an interrupted download never leaves a
+#   truncated data file behind
+# - interrupted downloads are resumed from the end of the .part file with REST
+
+import os
+import time
+import ftplib
+import threading
+from contextlib import contextmanager
+from . import instrument
+
+
+class FTPDownloader(object):
+    """
+    Downloads files over a small pool of reusable FTP sessions.
+
+    Parameters
+    ==========
+    host : str, optional
+        FTP server host name.
+    port : int, optional
+        FTP server port.
+    sessions : int, optional
+        Maximum number of FTP sessions kept open at once.
+    retries : int, optional
+        Number of times a failed download is retried.
+    backoff : float, optional
+        Wait before the first retry in seconds; doubled for every further retry.
+    timeout : float, optional
+        Timeout of FTP connections in seconds.
+
+    """
+
+    def __init__(self, host='isr.sri.com', port=21, sessions=1, retries=3, backoff=2., timeout=60.):
+
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(sessions)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows an FTP session from the pool, connecting if no idle session
+        is available.  Sessions that raise an error are closed rather than
+        returned to the pool.
+
+        """
+        with self._slots:
+            with self._lock:
+                ftp = self._idle.pop() if self._idle else None
+            if ftp is None:
+                ftp = ftplib.FTP(timeout=self.timeout)
+                ftp.connect(self.host, self.port)
+                ftp.login()
+                ftp.voidcmd('TYPE I')
+            try:
+                yield ftp
+            except ftplib.error_perm:
+                # refused command (e.g. missing file); the session itself is fine
+                with self._lock:
+                    self._idle.append(ftp)
+                raise
+            except BaseException:
+                ftp.close()
+                raise
+            with self._lock:
+                self._idle.append(ftp)
+
+    def download(self, ftp_path, output_filename):
+        """
+        Downloads a file, resuming any previous partial download of it and
+        retrying with exponential backoff if the transfer fails.
+
+        Parameters
+        ==========
+        ftp_path : str
+            Path of file on the FTP server.
+        output_filename : str
+            Path where the file will be saved.
+
+        Raises
+        ======
+        ftplib.error_perm
+            If the file does not exist on the server.
+
+        """
+        partial_filename = output_filename+'.part'
+
+        for attempt in range(self.retries+1):
+            try:
+                with self.session() as ftp:
+                    size = ftp.size(ftp_path)
+
+                    # resume from the end of a previous partial download
+                    offset = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+                    if offset > size:
+                        offset = 0
+
+                    try:
+                        with open(partial_filename, 'ab' if offset else 'wb') as f:
+                            ftp.retrbinary('RETR {}'.format(ftp_path), f.write, rest=offset or None)
+                    finally:
+                        if os.path.exists(partial_filename):
+                            instrument.count('bytes_downloaded', os.path.getsize(partial_filename)-offset)
+
+                if os.path.getsize(partial_filename) != size:
+                    raise IOError('Incomplete download of {}'.format(os.path.basename(output_filename)))
+
+                os.replace(partial_filename, output_filename)
+                return
+
+            except ftplib.error_perm:
+                # file is not available; retrying won't help
+                if os.path.exists(partial_filename) and os.path.getsize(partial_filename) == 0:
+                    os.remove(partial_filename)
+                raise
+            except (ftplib.Error, EOFError, OSError, IOError) as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.backoff*2**attempt
+                instrument.count('download_retries')
+                print('Problem downloading {} ({}), retrying in {:.0f} s'.format(os.path.basename(output_filename), e, wait))
+                time.sleep(wait)
+
+    def close(self):
+        """
+        Closes all idle FTP sessions.
+
+        """
+        with self._lock:
+            while self._idle:
+                ftp = self._idle.pop()
+                try:
+                    ftp.quit()
+                except (ftplib.Error, EOFError, OSError):
+                    ftp.close()
@@ -0,0 +1,422 @@
+# export.py
+# on-disk output of mosaic time series
+#
+# Notes:
+# - pyramids store every frame at full resolution (level 0) and at power-of-two downsampled
+#   levels, each the NaN-aware mean of 2x2 blocks of the level below
+# - pyramid image datasets are chunked in fixed size tiles of one frame, so a client only
+#   reads the tiles of the zoom level it is displaying
+# - pyramid file layout:
+#     /Time                 (frames,) unix timestamps of mosaics
+#     /level_N/Latitude     (rows, cols) grid latitude at level N
+#     /level_N/Longitude    (rows, cols) grid longitude at level N
+#     /level_N/ImageData    (frames, rows, cols) mosaic images at level N
+# - mosaic cubes store the full resolution time series in one dataset, one chunk per frame:
+#     /Time                 (frames,) unix timestamps of mosaics
+#     /TrueTime             (frames, sites) unix timestamps of site images (NaN if missing)
+#     /Sites                (sites,) site names
+#     /Latitude, /Longitude (rows, cols) grid coordinates
+#     /ImageData            (frames, rows, cols) mosaic images, optionally quantized
+#   quantized images follow the CF conventions (value = stored*scale_factor+add_offset,
+#   _FillValue where there is no data)
+
+import numpy as np
+import h5py
+import datetime as dt
+
+
+def valid_data(img, fill_value=np.nan):
+    """
+    Cells of a mosaic that have data.
+
+    Parameters
+    ==========
+    img : array
+        Mosaic image.
+    fill_value : float, optional
+        Value of cells without data.
+
+    Returns
+    =======
+    valid : array
+        True for cells with data.
+
+    """
+    img = np.asarray(img)
+    if np.issubdtype(img.dtype, np.integer):
+        return img != fill_value
+    if np.isnan(fill_value):
+        return np.isfinite(img)
+    return np.isfinite(img) & (img != fill_value)
+
+
+def downsample(img):
+    """
+    Halves the resolution of an image by averaging 2x2 blocks, ignoring NaNs.
+    Blocks with no valid pixels are NaN.  Images with an odd number of rows or
+    columns are padded with NaNs.
+
+    Parameters
+    ==========
+    img : array
+        Image, or stack of images with rows and columns as the last two axes.
+
+    Returns
+    =======
+    small : array
+        Downsampled image(s).
+
+    """
+    img = np.asarray(img, dtype=np.result_type(img, np.float32))
+    rows, cols = img.shape[-2:]
+    pad = [(0,0)]*(img.ndim-2)+[(0,rows%2),(0,cols%2)]
+    if rows%2 or cols%2:
+        img = np.pad(img, pad, mode='constant', constant_values=np.nan)
+
+    blocks = img.reshape(img.shape[:-2]+(img.shape[-2]//2,2,img.shape[-1]//2,2))
+    valid = np.isfinite(blocks)
+    total = np.where(valid,blocks,0.).sum(axis=(-3,-1))
+    count = valid.sum(axis=(-3,-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total/count).astype(img.dtype)
+
+
+def pyramid(img, levels):
+    """
+    Full resolution image followed by successively downsampled images.
+
+    Parameters
+    ==========
+    img : array
+        Full resolution image(s).
+    levels : int
+        Total number of levels, including the full resolution image.
+
+    Returns
+    =======
+    images : list
+        List of images, halving in resolution from one level to the next.
+
+    """
+    images = [img]
+    for __ in range(levels-1):
+        images.append(downsample(images[-1]))
+    return images
+
+
+def pyramid_levels(shape, tile_size):
+    """
+    Number of levels needed for the smallest level to fit in a single tile.
+
+    Parameters
+    ==========
+    shape : tuple
+        Rows and columns of full resolution image.
+    tile_size : int
+        Rows and columns of tiles.
+
+    Returns
+    =======
+    levels : int
+        Number of levels.
+
+    """
+    levels = 1
+    rows, cols = shape
+    while rows > tile_size or cols > tile_size:
+        rows, cols = (rows+1)//2, (cols+1)//2
+        levels += 1
+    return levels
+
+
+class PyramidWriter(object):
+    """
+    Writes mosaics to an hdf5 file as a tiled pyramid of downsampled levels.
+    Frames are appended to the file, so an existing file with the same grid
+    and tiling can be extended.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 filename.
+    grid : array
+        Background grid longitude and latitude values (as Mosaic.grid).
+    tile_size : int, optional
+        Rows and columns of tiles.
+    levels : int, optional
+        Number of levels.  Defaults to enough levels for the smallest level to
+        fit in a single tile.
+    compression : str, optional
+        hdf5 compression filter for image tiles.
+    fill_value : float, optional
+        Value of mosaic cells without data, which are stored as NaN.
+
+    """
+
+    def __init__(self, filename, grid, tile_size=256, levels=None, compression='gzip', fill_value=np.nan):
+
+        shape = grid.shape[1:]
+        if levels is None:
+            levels = pyramid_levels(shape, tile_size)
+
+        self.filename = filename
+        self.tile_size = tile_size
+        self.levels = levels
+        self.fill_value = fill_value
+        self.file = h5py.File(filename, 'a')
+
+        if 'Time' in self.file:
+            if (self.file.attrs['tile_size'] != tile_size or self.file.attrs['levels'] != levels
+                    or self.file['level_0/ImageData'].shape[1:] != shape):
+                self.file.close()
+                raise ValueError('{} was written with a different grid or tiling'.format(filename))
+            return
+
+        self.file.attrs['tile_size'] = tile_size
+        self.file.attrs['levels'] = levels
+        self.file.create_dataset('Time', shape=(0,), maxshape=(None,), dtype=np.float64)
+
+        for level, (lon, lat) in enumerate(zip(pyramid(grid[0],levels),pyramid(grid[1],levels))):
+            group = self.file.create_group('level_{}'.format(level))
+            group.create_dataset('Latitude', data=lat)
+            group.create_dataset('Longitude', data=lon)
+            chunks = (1,min(tile_size,lat.shape[0]),min(tile_size,lat.shape[1]))
+            group.create_dataset('ImageData', shape=(0,)+lat.shape, maxshape=(None,)+lat.shape, chunks=chunks,
+                                 dtype=np.float32, fillvalue=np.nan, compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def times(self):
+        """
+        Times of frames already in the file.
+
+        """
+        return [dt.datetime.utcfromtimestamp(t) for t in self.file['Time'][:]]
+
+    def write(self, time, img):
+        """
+        Appends a mosaic and its downsampled levels to the file.
+
+        Parameters
+        ==========
+        time : datetime object
+            Time of mosaic.
+        img : array
+            Full resolution mosaic image.
+
+        """
+        frame = self.file['Time'].shape[0]
+        full = np.asarray(img,dtype=np.float32)
+        if not np.isnan(self.fill_value):
+            full = np.where(valid_data(img,self.fill_value),full,np.float32(np.nan))
+
+        for level, image in enumerate(pyramid(full,self.levels)):
+            dataset = self.file['level_{}/ImageData'.format(level)]
+            dataset.resize(frame+1, axis=0)
+            dataset[frame] = image
+
+        # the time is written last, so it only counts as written once every level is stored
+        self.file['Time'].resize((frame+1,))
+        self.file['Time'][frame] = (time-dt.datetime.utcfromtimestamp(0)).total_seconds()
+
+    def close(self):
+        """
+        Closes the file.
+
+        """
+        self.file.close()
+
+
+class CubeWriter(object):
+    """
+    Writes a time series of full resolution mosaics to a single hdf5 dataset
+    chunked by frame.  Frames are appended to the file, so an existing file
+    with the same grid, sites and quantization can be extended.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 filename.
+    grid : array
+        Background grid longitude and latitude values (as Mosaic.grid).
+    sites : list
+        Names of the sites in the mosaic.
+    dtype : str, optional
+        Data type of stored images: 'float32', 'float16' or 'uint16'.
+        uint16 images are quantized with scale and offset.
+    scale : float, optional
+        Quantization step of uint16 images.
+    offset : float, optional
+        Value of zero in uint16 images.
+    compression : str, optional
+        hdf5 compression filter.  Uncompressed frames are read without any
+        decoding.
+    fill_value : float, optional
+        Value of mosaic cells without data.
+
+    """
+
+    uint16_fill = np.iinfo(np.uint16).max
+
+    def __init__(self, filename, grid, sites, dtype='float32', scale=1., offset=0., compression='gzip', fill_value=np.nan):
+
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float16, np.uint16):
+            raise ValueError('Unsupported mosaic cube data type {}'.format(dtype))
+
+        shape = grid.shape[1:]
+        self.filename = filename
+        self.dtype = dtype
+        self.fill_value = fill_value
+        self.file = h5py.File(filename, 'a')
+
+        if 'Time' in self.file:
+            images = self.file['ImageData']
+            if (images.shape[1:] != shape or images.dtype != dtype
+                    or [name.decode() if isinstance(name, bytes) else name for name in self.file['Sites'][:]] != list(sites)):
+                self.file.close()
+                raise ValueError('{} was written with a different grid, sites or data type'.format(filename))
+            self.scale = images.attrs.get('scale_factor', 1.)
+            self.offset = images.attrs.get('add_offset', 0.)
+            # drop any frame whose writing was interrupted before its time was stored
+            for name in ('TrueTime', 'ImageData'):
+                self.file[name].resize(self.file['Time'].shape[0], axis=0)
+            return
+
+        self.scale = scale
+        self.offset = offset
+
+        self.file.create_dataset('Time', shape=(0,), maxshape=(None,), dtype=np.float64)
+        self.file.create_dataset('TrueTime', shape=(0,len(sites)), maxshape=(None,len(sites)), dtype=np.float64)
+        self.file.create_dataset('Sites', data=list(sites), dtype=h5py.string_dtype())
+        self.file.create_dataset('Latitude', data=grid[1])
+        self.file.create_dataset('Longitude', data=grid[0])
+
+        fillvalue = self.uint16_fill if dtype == np.uint16 else np.nan
+        images = self.file.create_dataset('ImageData', shape=(0,)+shape, maxshape=(None,)+shape, chunks=(1,)+shape,
+                                          dtype=dtype, fillvalue=fillvalue, compression=compression)
+        if dtype == np.uint16:
+            images.attrs['scale_factor'] = scale
+            images.attrs['add_offset'] = offset
+            images.attrs['_FillValue'] = fillvalue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def times(self):
+        """
+        Times of frames already in the file.
+
+        """
+        return [dt.datetime.utcfromtimestamp(t) for t in self.file['Time'][:]]
+
+    def quantize(self, img):
+        """
+        Converts a mosaic image to the stored data type.
+
+        Parameters
+        ==========
+        img : array
+            Mosaic image.
+
+        Returns
+        =======
+        stored : array
+            Image as stored in the file.
+
+        """
+        img = np.asarray(img)
+        missing = ~valid_data(img,self.fill_value)
+
+        if self.dtype != np.uint16:
+            stored = img.astype(self.dtype)
+            stored[missing] = np.nan
+            return stored
+
+        if img.dtype == np.uint16 and self.scale == 1. and self.offset == 0.:
+            # raw counts are stored as they are
+            stored = np.minimum(img, self.uint16_fill-1)
+        else:
+            with np.errstate(invalid='ignore'):
+                stored = np.rint((img.astype(np.float32)-np.float32(self.offset))/np.float32(self.scale))
+            stored = np.clip(np.nan_to_num(stored), 0, self.uint16_fill-1).astype(np.uint16)
+        stored[missing] = self.uint16_fill
+        return stored
+
+    def write(self, time, img, truetime):
+        """
+        Appends a mosaic to the file.
+
+        Parameters
+        ==========
+        time : datetime object
+            Time of mosaic.
+        img : array
+            Mosaic image.
+        truetime : list
+            Time each site's image was taken ('' or None for sites without
+            data), as returned by Mosaic.grid_mosaic.
+
+        """
+        epoch = dt.datetime.utcfromtimestamp(0)
+        frame = self.file['Time'].shape[0]
+        for name in ('TrueTime', 'ImageData'):
+            self.file[name].resize(frame+1, axis=0)
+        self.file['ImageData'][frame] = self.quantize(img)
+        self.file['TrueTime'][frame] = [(tt-epoch).total_seconds() if tt else np.nan for tt in truetime]
+
+        # the time is written last, so it only counts as written once the image is stored
+        self.file['Time'].resize((frame+1,))
+        self.file['Time'][frame] = (time-epoch).total_seconds()
+
+    def close(self):
+        """
+        Closes the file.
+
+        """
+        self.file.close()
+
+
+def read_cube(filename, frames=slice(None)):
+    """
+    Reads mosaics from a mosaic cube, undoing any quantization.
+
+    Parameters
+    ==========
+    filename : str
+        hdf5 filename.
+    frames : slice or array, optional
+        Frames to read.  Defaults to all frames.
+
+    Returns
+    =======
+    img : array
+        Mosaic images (frames, rows, cols); NaN where there is no data.
+    time : list
+        Times of mosaics.
+    truetime : array
+        Unix timestamps of site images (frames, sites); NaN if missing.
+
+    """
+    with h5py.File(filename, 'r') as f:
+        images = f['ImageData']
+        # frames whose writing was interrupted have no time and aren't part of the cube
+        if isinstance(frames, slice):
+            frames = slice(*frames.indices(f['Time'].shape[0]))
+        img = images[frames]
+        if images.dtype == np.uint16:
+            missing = img == images.attrs['_FillValue']
+            img = img*np.float32(images.attrs['scale_factor'])+np.float32(images.attrs['add_offset'])
+            img[missing] = np.nan
+        time = [dt.datetime.utcfromtimestamp(t) for t in np.atleast_1d(f['Time'][frames])]
+        truetime = f['TrueTime'][frames]
+    return img, time, truetime
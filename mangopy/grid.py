@@ -0,0 +1,245 @@
+# grid.py
+# background grid definitions for MANGO mosaics
+#
+# - grids are either regular in latitude/longitude, or regular in km on a
+#   (spherical) Lambert azimuthal equal-area projection centered on the grid
+# - longitudes are in the 0-360 degree convention used by the mosaic grid
+
+import numpy as np
+
+
+# radius of earth in kilometers
+RE = 6371.
+
+
+class GridSpec(object):
+    """
+    Definition of the background grid that site images are regridded onto.
+
+    Parameters
+    ==========
+    latmin : float, optional
+        Southern edge of grid (degrees).
+    latmax : float, optional
+        Northern edge of grid (degrees).
+    lonmin : float, optional
+        Western edge of grid (degrees, 0-360).
+    lonmax : float, optional
+        Eastern edge of grid (degrees, 0-360).
+    latstp : float, optional
+        Latitude resolution (degrees) of latitude/longitude grids.
+    lonstp : float, optional
+        Longitude resolution (degrees) of latitude/longitude grids.
+    resolution : float, optional
+        If given, the grid is an equal-area grid with this resolution in km
+        that covers the latitude/longitude box.
+    map_center : tuple, optional
+        (latitude, longitude) of the center of plotted maps.  Defaults to
+        the center of the grid.
+    map_extent : tuple, optional
+        (lonmin, lonmax, latmin, latmax) of plotted maps.  Defaults to the
+        extent of the grid.
+
+    """
+
+    def __init__(self, latmin=25., latmax=55., lonmin=225., lonmax=300., latstp=0.02, lonstp=0.03,
+                 resolution=None, map_center=None, map_extent=None):
+
+        self.latmin = latmin
+        self.latmax = latmax
+        self.lonmin = lonmin
+        self.lonmax = lonmax
+        self.latstp = latstp
+        self.lonstp = lonstp
+        self.resolution = resolution
+
+        # center of the equal-area projection
+        self.center_lat = (latmin+latmax)/2.
+        self.center_lon = (lonmin+lonmax)/2.
+
+        self.map_center = map_center if map_center is not None else (self.center_lat, self.center_lon)
+        self.map_extent = map_extent if map_extent is not None else (lonmin, lonmax, latmin, latmax)
+
+    def __repr__(self):
+        return ('GridSpec(latmin={}, latmax={}, lonmin={}, lonmax={}, latstp={}, lonstp={}, resolution={})'
+                .format(self.latmin, self.latmax, self.lonmin, self.lonmax, self.latstp, self.lonstp, self.resolution))
+
+    def grid(self):
+        """
+        Create base background grid.
+
+        Returns
+        =======
+        grid_array : array
+            Array of grid longitude and latitude values.
+        edge_array : array
+            Array of edge longitude and latitude values.
+
+        """
+        if self.resolution is None:
+            lat_arr = np.arange(self.latmin,self.latmax,self.latstp)
+            lon_arr = np.arange(self.lonmin,self.lonmax,self.lonstp)
+
+            grid_lon, grid_lat = np.meshgrid(lon_arr,lat_arr)
+            edge_lon, edge_lat = np.meshgrid(np.arange(self.lonmin-0.5*self.lonstp,self.lonmax,self.lonstp),
+                                             np.arange(self.latmin-0.5*self.latstp,self.latmax,self.latstp))
+        else:
+            x_arr, y_arr = self.xy_axes()
+            grid_lat, grid_lon = self.inverse(*np.meshgrid(x_arr,y_arr))
+            edge_lat, edge_lon = self.inverse(*np.meshgrid(np.append(x_arr-0.5*self.resolution,x_arr[-1]+0.5*self.resolution),
+                                                           np.append(y_arr-0.5*self.resolution,y_arr[-1]+0.5*self.resolution)))
+
+        grid_array = np.array([grid_lon, grid_lat])
+        edge_array = np.array([edge_lon, edge_lat])
+        return grid_array, edge_array
+
+    def xy_axes(self):
+        """
+        Projected coordinates (km) of the columns and rows of an equal-area grid.
+
+        Returns
+        =======
+        x_arr : array
+            East coordinate of grid columns.
+        y_arr : array
+            North coordinate of grid rows.
+
+        """
+        # project the edges of the latitude/longitude box to find its extent
+        edge_lat = np.concatenate([np.linspace(self.latmin,self.latmax,100),np.full(100,self.latmax),
+                                   np.linspace(self.latmax,self.latmin,100),np.full(100,self.latmin)])
+        edge_lon = np.concatenate([np.full(100,self.lonmin),np.linspace(self.lonmin,self.lonmax,100),
+                                   np.full(100,self.lonmax),np.linspace(self.lonmax,self.lonmin,100)])
+        x, y = self.forward(edge_lat,edge_lon)
+
+        x_arr = np.arange(np.floor(x.min()/self.resolution),np.ceil(x.max()/self.resolution)+1)*self.resolution
+        y_arr = np.arange(np.floor(y.min()/self.resolution),np.ceil(y.max()/self.resolution)+1)*self.resolution
+        return x_arr, y_arr
+
+    def forward(self, lat, lon):
+        """
+        Lambert azimuthal equal-area projection centered on the grid.
+
+        Parameters
+        ==========
+        lat : array
+            Latitude (degrees).
+        lon : array
+            Longitude (degrees).
+
+        Returns
+        =======
+        x : array
+            East coordinate (km).
+        y : array
+            North coordinate (km).
+
+        """
+        lat0 = np.radians(self.center_lat)
+        lat = np.radians(lat)
+        dlon = np.radians(np.asarray(lon)-self.center_lon)
+
+        k = np.sqrt(2./(1.+np.sin(lat0)*np.sin(lat)+np.cos(lat0)*np.cos(lat)*np.cos(dlon)))
+        x = RE*k*np.cos(lat)*np.sin(dlon)
+        y = RE*k*(np.cos(lat0)*np.sin(lat)-np.sin(lat0)*np.cos(lat)*np.cos(dlon))
+        return x, y
+
+    def inverse(self, x, y):
+        """
+        Inverse of the Lambert azimuthal equal-area projection centered on the grid.
+
+        Parameters
+        ==========
+        x : array
+            East coordinate (km).
+        y : array
+            North coordinate (km).
+
+        Returns
+        =======
+        lat : array
+            Latitude (degrees).
+        lon : array
+            Longitude (degrees, 0-360).
+
+        """
+        lat0 = np.radians(self.center_lat)
+        rho = np.hypot(x,y)
+        c = 2.*np.arcsin(np.clip(rho/(2.*RE),-1.,1.))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lat = np.arcsin(np.cos(c)*np.sin(lat0)+np.where(rho>0.,y*np.sin(c)*np.cos(lat0)/rho,0.))
+        lon = np.radians(self.center_lon)+np.arctan2(x*np.sin(c),rho*np.cos(lat0)*np.cos(c)-y*np.sin(lat0)*np.sin(c))
+        return np.degrees(lat), np.degrees(lon)%360.
+
+    def locate(self, lat, lon):
+        """
+        Index of the grid cell containing each point.
+
+        Parameters
+        ==========
+        lat : array
+            Latitude (degrees).
+        lon : array
+            Longitude (degrees).
+
+        Returns
+        =======
+        index : array
+            Flattened index into the grid of the cell containing each point
+            (-1 for points outside the grid).
+
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if self.resolution is None:
+            nrows = np.arange(self.latmin,self.latmax,self.latstp).size
+            ncols = np.arange(self.lonmin,self.lonmax,self.lonstp).size
+            with np.errstate(invalid='ignore'):
+                row = np.rint((lat-self.latmin)/self.latstp)
+                col = np.rint(((lon-self.lonmin)%360.)/self.lonstp)
+        else:
+            x_arr, y_arr = self.xy_axes()
+            nrows, ncols = y_arr.size, x_arr.size
+            x, y = self.forward(lat,lon)
+            with np.errstate(invalid='ignore'):
+                row = np.rint((y-y_arr[0])/self.resolution)
+                col = np.rint((x-x_arr[0])/self.resolution)
+
+        inside = (row>=0) & (row<nrows) & (col>=0) & (col<ncols)
+        return np.where(inside, np.where(inside,row,0)*ncols+np.where(inside,col,0), -1).astype(np.int64)
+
+    def distance(self, lat, lon):
+        """
+        Approximate distance (km) of a point from the grid; zero if the point
+        is inside the grid.
+
+        Parameters
+        ==========
+        lat : float
+            Latitude (degrees).
+        lon : float
+            Longitude (degrees).
+
+        Returns
+        =======
+        km : float
+            Distance from the grid in kilometers.
+
+        """
+        if self.resolution is None:
+            # closest point of the latitude/longitude box
+            dlon = (lon-self.lonmin)%360.
+            width = self.lonmax-self.lonmin
+            if dlon > width:
+                # outside the box; clamp to the closer of its east and west edges
+                dlon = width if dlon-width < 360.-dlon else 0.
+            near_lon = np.radians(self.lonmin+dlon)
+            near_lat = np.radians(np.clip(lat,self.latmin,self.latmax))
+            lat = np.radians(lat)
+            lon = np.radians(lon)
+            a = np.sin((lat-near_lat)/2)**2+np.cos(lat)*np.cos(near_lat)*np.sin((lon-near_lon)/2)**2
+            return 2*RE*np.arcsin(np.sqrt(a))
+
+        x_arr, y_arr = self.xy_axes()
+        x, y = self.forward(lat,lon)
+        return np.hypot(x-np.clip(x,x_arr[0],x_arr[-1]),y-np.clip(y,y_arr[0],y_arr[-1]))
@@ -0,0 +1,279 @@
+# instrument.py
+# timing and I/O instrumentation of Mango and Mosaic
+#
+# Notes:
+# - methods of Mango and Mosaic are wrapped with timed() and report counters (bytes read,
+#   bytes downloaded, cache hits and misses) and failures to every active Profiler
+# - when no Profiler is active, the only cost of a hook is checking an empty list
+# - profilers record calls in the current process only; worker processes of
+#   create_all_mosaic are not included
+
+import json
+import time
+import threading
+import functools
+
+
+# profilers that are currently recording
+_active = []
+
+
+class Profiler(object):
+    """
+    Records the wall time of each stage of reading data and creating mosaics,
+    I/O counters and failures, while it is active (as a context manager or
+    between start and stop).
+
+    Attributes
+    ==========
+    timings : dict
+        [calls, total seconds, longest call in seconds], keyed by (stage, site).
+    counters : dict
+        Counter values, keyed by (name, site).
+    failures : list
+        Dictionaries with the stage, site, error and time of each failure.
+
+    """
+
+    def __init__(self):
+
+        self.timings = {}
+        self.counters = {}
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """
+        Starts recording.
+
+        """
+        if self not in _active:
+            _active.append(self)
+
+    def stop(self):
+        """
+        Stops recording.
+
+        """
+        if self in _active:
+            _active.remove(self)
+
+    def record_time(self, stage, seconds, site=''):
+        """
+        Records the wall time of a call.
+
+        Parameters
+        ==========
+        stage : str
+            Name of stage (method).
+        seconds : float
+            Wall time of call.
+        site : str, optional
+            Site name, for calls that work on a single site.
+
+        """
+        with self._lock:
+            timing = self.timings.setdefault((stage, site), [0, 0., 0.])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def count(self, name, value=1, site=''):
+        """
+        Adds to a counter.
+
+        Parameters
+        ==========
+        name : str
+            Name of counter.
+        value : int, optional
+            Amount added.
+        site : str, optional
+            Site name, for counters of a single site.
+
+        """
+        with self._lock:
+            self.counters[(name, site)] = self.counters.get((name, site), 0)+value
+
+    def failure(self, stage, site, error):
+        """
+        Records a failure.
+
+        Parameters
+        ==========
+        stage : str
+            Name of stage (method).
+        site : str
+            Site name.
+        error : Exception
+            Error that was raised.
+
+        """
+        with self._lock:
+            self.failures.append({'stage':stage, 'site':site, 'error':str(error), 'time':time.time()})
+
+    def to_dict(self):
+        """
+        All recorded values.
+
+        Returns
+        =======
+        values : dict
+            Lists of timings, counters and failures.
+
+        """
+        with self._lock:
+            return {'timings':[{'stage':stage, 'site':site, 'calls':calls, 'seconds':total, 'max_seconds':longest}
+                               for (stage, site), (calls, total, longest) in sorted(self.timings.items())],
+                    'counters':[{'name':name, 'site':site, 'value':value}
+                                for (name, site), value in sorted(self.counters.items())],
+                    'failures':list(self.failures)}
+
+    def to_json(self, filename=None):
+        """
+        Recorded values as JSON.
+
+        Parameters
+        ==========
+        filename : str, optional
+            If given, the JSON is also written to this file.
+
+        Returns
+        =======
+        text : str
+            JSON text.
+
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, prefix='mangopy'):
+        """
+        Recorded values in the Prometheus text exposition format.
+
+        Parameters
+        ==========
+        prefix : str, optional
+            Prefix of metric names.
+
+        Returns
+        =======
+        text : str
+            Metrics.
+
+        """
+        def labels(**kwargs):
+            kwargs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in kwargs.items() if v]
+            return '{{{}}}'.format(','.join(kwargs)) if kwargs else ''
+
+        values = self.to_dict()
+        lines = []
+        for metric, key, kind in [('calls_total','calls','counter'), ('seconds_total','seconds','counter'),
+                                  ('seconds_max','max_seconds','gauge')]:
+            lines.append('# TYPE {}_{} {}'.format(prefix, metric, kind))
+            lines.extend('{}_{}{} {}'.format(prefix, metric, labels(stage=t['stage'], site=t['site']), t[key])
+                         for t in values['timings'])
+
+        for name in sorted(set(c['name'] for c in values['counters'])):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.extend('{}_{}_total{} {}'.format(prefix, name, labels(site=c['site']), c['value'])
+                         for c in values['counters'] if c['name'] == name)
+
+        failures = {}
+        for f in values['failures']:
+            failures[(f['stage'], f['site'])] = failures.get((f['stage'], f['site']), 0)+1
+        lines.append('# TYPE {}_failures_total counter'.format(prefix))
+        lines.extend('{}_failures_total{} {}'.format(prefix, labels(stage=stage, site=site), n)
+                     for (stage, site), n in sorted(failures.items()))
+
+        return '\n'.join(lines)+'\n'
+
+    def summary(self):
+        """
+        Prints a table of the recorded timings, counters and failures.
+
+        """
+        values = self.to_dict()
+        print('{:28s} {:32s} {:>8s} {:>12s} {:>12s}'.format('stage', 'site', 'calls', 'total (s)', 'max (s)'))
+        for t in sorted(values['timings'], key=lambda t: -t['seconds']):
+            print('{:28s} {:32s} {:8d} {:12.4f} {:12.4f}'.format(t['stage'], t['site'], t['calls'], t['seconds'], t['max_seconds']))
+        for c in values['counters']:
+            print('{:28s} {:32s} {:>8}'.format(c['name'], c['site'], c['value']))
+        for f in values['failures']:
+            print('failed: {} {} ({})'.format(f['stage'], f['site'], f['error']))
+
+
+def timed(stage, site=False):
+    """
+    Decorator recording the wall time of each call of a method.
+
+    Parameters
+    ==========
+    stage : str
+        Name of stage.
+    site : bool, optional
+        If True, the first argument after self is a site dictionary and
+        calls are recorded separately for each site.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return method(*args, **kwargs)
+            name = args[1]['name'] if site and len(args) > 1 and isinstance(args[1], dict) else ''
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter()-start
+                for profiler in list(_active):
+                    profiler.record_time(stage, seconds, name)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1, site=''):
+    """
+    Adds to a counter of every active profiler.
+
+    Parameters
+    ==========
+    name : str
+        Name of counter.
+    value : int, optional
+        Amount added.
+    site : str, optional
+        Site name.
+
+    """
+    for profiler in list(_active):
+        profiler.count(name, value, site)
+
+
+def failure(stage, site, error):
+    """
+    Records a failure in every active profiler.
+
+    Parameters
+    ==========
+    stage : str
+        Name of stage.
+    site : str
+        Site name.
+    error : Exception
+        Error that was raised.
+
+    """
+    for profiler in list(_active):
+        profiler.failure(stage, site, error)
@@ -5,23 +5,26 @@
 # Notes:
 # - Default data directory is TEMP/MANGOData/, where TEMP is defined by tempfile.gettempdir() (https://docs.python.org/3/library/tempfile.html)
 # - TODO: Data files availabe at ftp://isr.sri.com/pub/earthcube/provider/asti/MANGOProcessed/
+# - matplotlib and cartopy are only imported by the plotting methods, so reading data
+#   doesn't pay for importing them
+# - with calibrate=True, images are calibrated for the background and gain of each
+#   site and night as they are read (see calibrate.py)
 
 import numpy as np
 import datetime as dt
 import h5py
-import csv
-import matplotlib.pyplot as plt
-try:
-    import cartopy.crs as ccrs
-    import cartopy.feature as cfeature
-except ImportError:
-    print('WARNING: cartopy is not installed')
 import os
 # import urllib
 # from contextlib import closing
 import tempfile
 import ftplib
-from future.utils import raise_from
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .download import FTPDownloader
+from .sites import SiteRegistry
+from .calibrate import night_statistics, load_calibration, save_calibration
+from . import instrument
 
 
 class Mango(object):
@@ -34,10 +37,28 @@ class Mango(object):
         Path to exisiting directory containing MANGO data.
     download_data : bool, optional
         If True, downloads data from ftp server.
+    max_open_files : int, optional
+        Maximum number of data files kept open between reads.  Least
+        recently used files are closed once this is exceeded.
+    use_memmap : bool, optional
+        If True, image data in uncompressed, contiguous data files is read
+        through a read-only memory map instead of h5py.
+    site_file : str, optional
+        csv file of sites that extend or replace the sites in
+        SiteInformation.csv (see sites.py).
+    calibrate : bool, optional
+        If True, images are returned as (image-background)/scale (float32),
+        with the background and scale of each pixel calculated over the
+        night of the data file.
 
     """
 
-    def __init__(self, datadir=None, download_data = False):
+    # ftp server with processed MANGO data files
+    ftp_host = 'isr.sri.com'
+    ftp_port = 21
+
+    def __init__(self, datadir=None, download_data = False, max_open_files=16, use_memmap=True, site_file=None,
+                 calibrate=False):
 
         self.mangopy_path = os.path.dirname(os.path.realpath(__file__))
         # if no data directory specified, use a default temp directory
@@ -46,8 +67,40 @@ class Mango(object):
             print('No data directory has been specified!  If data is downloaded, it will be saved to {}.  This is also where mangopy will look for existing data files.'.format(datadir))
         self.datadir = datadir
         self.download_data = download_data
+        self.site_file = site_file
+        self.sites = SiteRegistry.load(site_file)
+        self.calibrate = calibrate
+
+        # open hdf5 handles and decoded Time/Latitude/Longitude arrays, keyed by filename
+        self.max_open_files = max_open_files
+        self.use_memmap = use_memmap
+        self._open_files = OrderedDict()
+        self._file_lock = threading.RLock()
+
+        # locks of files being downloaded or calibrated, so each file is only downloaded
+        # (or calibrated) once while other files can be read
+        self._download_locks = {}
+        self._calibration_locks = {}
+        self._locks_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes all data files held open by the file cache.
+
+        """
+        with self._file_lock:
+            while self._open_files:
+                __, entry = self._open_files.popitem()
+                entry['file'].close()
 
 
+    @instrument.timed('plot', site=True)
     def plot(self,site,targtime):
 
         """
@@ -61,12 +114,15 @@ class Mango(object):
             Time of image as requested by user.
 
         """
+        import matplotlib.pyplot as plt
+
         # plot single mango image
         img, __, __, truetime = self.get_data(site, targtime)
         plt.imshow(img, cmap=plt.get_cmap('gist_heat'))
         plt.title('{:%Y-%m-%d %H:%M}'.format(truetime))
         plt.show()
 
+    @instrument.timed('map', site=True)
     def map(self,site,targtime):
 
         """
@@ -81,6 +137,10 @@ class Mango(object):
 
 
         """
+        import matplotlib.pyplot as plt
+        import cartopy.crs as ccrs
+        import cartopy.feature as cfeature
+
         # map single mango image
         img, lat, lon, truetime = self.get_data(site,targtime)
 
@@ -101,7 +161,8 @@ class Mango(object):
 
         plt.show()
 
-    def get_data(self,site,targtime):
+    @instrument.timed('get_data', site=True)
+    def get_data(self,site,targtime,copy=True):
 
         """
         Accesses the images and position of a site, given the site name and time.
@@ -112,6 +173,10 @@ class Mango(object):
             Camera site name
         targtime : datetime object
             Time of image as requested by user.
+        copy : bool, optional
+            If False, the arrays may be read-only views of the data file (memory
+            mapped images and the cached coordinates), which saves copying them.
+            Defaults to True.
 
         Returns
         =======
@@ -126,24 +191,293 @@ class Mango(object):
 
 
         """
+        # don't look for data from sites that weren't operating
+        if not self.sites.operational(site,targtime):
+            raise ValueError('{} was not operating on {:%Y-%m-%d}.'.format(site['name'],targtime))
+
         # read mango data file
-        filename = os.path.join(self.datadir,'{0}/{1:%b%d%y}/{2}{1:%b%d%y}.h5'.format(site['name'],targtime,site['code']))
+        img_array, lat, lon, truetime = self.read_or_fetch(site,targtime.date(),self.read_datafile,targtime)
+        if copy:
+            img_array, lat, lon = np.array(img_array), np.array(lat), np.array(lon)
+
+        return img_array, lat, lon, truetime
+
+    @instrument.timed('get_data_range', site=True)
+    def get_data_range(self,site,times,fill_value=None):
+
+        """
+        Accesses the images of a site at many times at once.  Frames are read
+        with as few hdf5 reads as possible and returned as a single stacked array.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        times : list of datetime objects
+            Times of images as requested by user.
+        fill_value : float, optional
+            Value used for requested times that have no image within 5 minutes,
+            including times on days without a data file.  If not given, a
+            ValueError is raised for such times.
+
+        Returns
+        =======
+        img_array : array
+            Image array with shape (len(times), rows, columns)
+        lat : float
+            Latitude array (read-only, shared by all reads of the file)
+        lon : float
+            Longitude array (read-only, shared by all reads of the file)
+        truetime : list of datetime objects
+            Times at which images were taken (None for missing images).
+
+        """
+        times = list(times)
+        file_times = self.group_by_file(times)
+
+        # don't look for data from sites that weren't operating
+        offline = [date for date in file_times if not self.sites.operational(site,date)]
+        if offline and (fill_value is None or len(offline) == len(file_times)):
+            raise ValueError('{} was not operating on {}.'.format(site['name'],', '.join('{:%Y-%m-%d}'.format(date) for date in offline)))
+
+        img_array = None
+        truetime = [None]*len(times)
+        for date, tidx in file_times.items():
+            if date in offline:
+                continue
+            targtimes = [times[i] for i in tidx]
+            try:
+                imgs, lat, lon, tt = self.read_or_fetch(site,date,self.read_datafile_range,targtimes,fill_value)
+            except (OSError, IOError, ValueError) as e:
+                # with a fill_value, days without a data file are filled like days the site wasn't operating
+                if fill_value is None or len(file_times) == 1:
+                    raise
+                error = e
+                continue
+
+            # a single data file needs no further copying
+            if len(file_times) == 1:
+                return imgs, lat, lon, tt
+
+            if img_array is None:
+                # later files may have missing frames even if this one doesn't, so make room for fill_value
+                if fill_value is None:
+                    img_array = np.empty((len(times),)+imgs.shape[1:], dtype=imgs.dtype)
+                else:
+                    img_array = np.full((len(times),)+imgs.shape[1:], fill_value, dtype=np.result_type(imgs.dtype,fill_value))
+                lat0, lon0 = lat, lon
+            img_array[tidx] = imgs
+            for i, t in zip(tidx, tt):
+                truetime[i] = t
+
+        if img_array is None:
+            if file_times:
+                # none of the data files could be read
+                raise error
+            raise ValueError('No times requested.')
+
+        return img_array, lat0, lon0, truetime
+
+    def get_data_interval(self,site,starttime,endtime,cadence=5,fill_value=None):
+
+        """
+        Accesses the images of a site at regular intervals between two times.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        starttime : datetime object
+            Time of first image.
+        endtime : datetime object
+            Time of last image.
+        cadence : float, optional
+            Time between images in minutes.  Defaults to 5.
+        fill_value : float, optional
+            Value used for requested times that have no image within 5 minutes.
+
+        Returns
+        =======
+        img_array : array
+            Image array with shape (number of times, rows, columns)
+        lat : float
+            Latitude array
+        lon : float
+            Longitude array
+        truetime : list of datetime objects
+            Times at which images were taken (None for missing images).
+
+        """
+        num_frames = int((endtime-starttime).total_seconds()/60./cadence)+1
+        time_list = [starttime+dt.timedelta(minutes=i*cadence) for i in range(num_frames)]
+        return self.get_data_range(site,time_list,fill_value=fill_value)
+
+    @instrument.timed('get_data_aligned', site=True)
+    def get_data_aligned(self,site,times,method='linear',max_skew=5.,fill_value=np.nan):
+
+        """
+        Accesses the images of a site aligned to a common timeline.  Each
+        requested time gets either the nearest image or a linear blend of the
+        two images bracketing it, using only images within max_skew of the
+        requested time.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        times : list of datetime objects
+            Times of images as requested by user.
+        method : str, optional
+            'nearest' or 'linear'.  Defaults to 'linear'.
+        max_skew : float, optional
+            Largest time difference (minutes) between a requested time and
+            an image used for it.  Defaults to 5.
+        fill_value : float, optional
+            Value used for requested times that have no image within max_skew.
+
+        Returns
+        =======
+        img_array : array
+            Image array with shape (len(times), rows, columns)
+        lat : float
+            Latitude array (read-only, shared by all reads of the file)
+        lon : float
+            Longitude array (read-only, shared by all reads of the file)
+        skew : array
+            Largest time difference (seconds) between each requested time and
+            the images used for it (NaN for missing images).
+
+        """
+        times = list(times)
+        file_times = self.group_by_file(times)
+
+        img_array = None
+        skew = np.full(len(times),np.nan)
+        for date, tidx in file_times.items():
+            # don't look for data from sites that weren't operating
+            if not self.sites.operational(site,date):
+                continue
+            targtimes = [times[i] for i in tidx]
+            imgs, lat, lon, sk = self.read_or_fetch(site,date,self.read_datafile_aligned,targtimes,method,max_skew,fill_value)
+
+            # a single data file needs no further copying
+            if len(file_times) == 1:
+                return imgs, lat, lon, sk
+
+            if img_array is None:
+                img_array = np.full((len(times),)+imgs.shape[1:], fill_value, dtype=imgs.dtype)
+                lat0, lon0 = lat, lon
+            img_array[tidx] = imgs
+            skew[tidx] = sk
+
+        if img_array is None:
+            raise ValueError('{} has no data for the requested times.'.format(site['name']))
+
+        return img_array, lat0, lon0, skew
+
+    def get_coordinates(self,site,date):
+
+        """
+        Accesses the latitude and longitude of every pixel of a site's images
+        on a particular date, without reading any images.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        date : datetime object
+            Date (or time) of data file.
+
+        Returns
+        =======
+        lat : float
+            Latitude array (read-only, shared by all reads of the file)
+        lon : float
+            Longitude array (read-only, shared by all reads of the file)
+
+        """
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        entry = self.read_or_fetch(site,date,self.open_datafile)
+        return entry['lat'], entry['lon']
+
+    def group_by_file(self,times):
+        """
+        Helper function for getting data at many times; groups requested times
+        by daily data file.
+
+        Parameters
+        ==========
+        times : list of datetime objects
+            Times of images as requested by user.
+
+        Returns
+        =======
+        file_times : OrderedDict
+            Indices (into times) of the requested times on each date, keyed by
+            date in the order dates are first requested.
+
+        """
+        file_times = OrderedDict()
+        for i, targtime in enumerate(times):
+            file_times.setdefault(targtime.date(),[]).append(i)
+        return file_times
+
+    def read_or_fetch(self,site,date,read,*args):
+        """
+        Helper function for getting data; reads a site's data file for a date,
+        downloading it first if it isn't available locally and download_data
+        is set.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        date : date object
+            Date of data file.
+        read : function
+            Function reading the data file, called as read(filename, *args).
+
+        Returns
+        =======
+        result
+            Return value of read.
+
+        """
+        filename = self.datafile_name(site,date)
 
         # first try to read data file locally
         try:
-            img_array, lat, lon, truetime = self.read_datafile(filename,targtime)
+            return read(filename,*args)
         # if that fails, try to download, then read the data file
         except (OSError, IOError):
-            if self.download_data:
-                print('Attempting to download {} from FTP server.'.format(os.path.basename(filename)))
-                self.fetch_datafile(site, targtime.date())
-                img_array, lat, lon, truetime = self.read_datafile(filename, targtime)
-            else:
+            if not self.download_data:
                 raise OSError('No data found locally, unable to access FTP server upon user request.')
+        print('Attempting to download {} from FTP server.'.format(os.path.basename(filename)))
+        self.fetch_datafile(site, date)
+        return read(filename,*args)
 
-        return img_array, lat, lon, truetime
+    def datafile_name(self,site,date):
+        """
+        Path of the daily data file for a site.
+
+        Parameters
+        ==========
+        site : str
+            Camera site name
+        date : datetime or date object
+            Date of data file.
+
+        Returns
+        =======
+        filename : str
+            hdf5 filename
+
+        """
+        return os.path.join(self.datadir,'{0}/{1:%b%d%y}/{2}{1:%b%d%y}.h5'.format(site['name'],date,site['code']))
 
 
+    @instrument.timed('read_datafile')
     def read_datafile(self,filename,targtime):
         """
         Helper function for getting data; reads data in from hdf5 file.
@@ -158,17 +492,23 @@ class Mango(object):
         Returns
         =======
         img_array : array
-            Image array
+            Image array (a read-only view of memory mapped files)
         lat : float
-            Latitude array
+            Latitude array (read-only, shared by all reads of the file)
         lon : float
-            Longitude array
+            Longitude array (read-only, shared by all reads of the file)
         truetime : datetime object
             Time image was taken
         """
-        with h5py.File(filename, 'r') as file:
+        # calibrations are calculated before taking the file lock, which reading a whole night would hold
+        calibration = self.calibration_arrays(filename) if self.calibrate else None
+
+        # hold the lock so another thread can't close the file while it is being read
+        with self._file_lock:
+            entry = self.open_datafile(filename)
+
             tstmp0 = (targtime-dt.datetime.utcfromtimestamp(0)).total_seconds()
-            tstmp = file['Time'][:]
+            tstmp = entry['time']
             t = np.argmin(np.abs(tstmp-tstmp0))
             truetime = dt.datetime.utcfromtimestamp(tstmp[t])
 
@@ -176,13 +516,404 @@ class Mango(object):
             if np.abs((targtime-truetime).total_seconds())>5.*60.:
                 raise ValueError('Requested time {:%H:%M:%S} not included in {}'.format(targtime,os.path.basename(filename)))
 
-            img_array = file['ImageData'][t,:,:]
-            lat = file['Latitude'][:]
-            lon = file['Longitude'][:]
+            img_array = entry['images'][t,:,:]
+            instrument.count('hdf5_bytes_read', img_array.nbytes)
+            if calibration is not None:
+                img_array = self.calibrate_images(img_array,calibration)
+            lat = entry['lat']
+            lon = entry['lon']
 
-        return img_array, lat, lon, truetime
+            return img_array, lat, lon, truetime
+
+    @instrument.timed('read_datafile_aligned')
+    def read_datafile_aligned(self,filename,targtimes,method='linear',max_skew=5.,fill_value=np.nan):
+        """
+        Helper function for getting time-aligned data; reads the frames
+        bracketing each requested time from a single hdf5 file and either
+        picks the nearest one or blends them linearly in time.  All frames
+        needed are read at once with a single contiguous hyperslab read.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+        targtimes : list of datetime objects
+            Times of images as requested by user
+        method : str, optional
+            'nearest' or 'linear'.
+        max_skew : float, optional
+            Largest time difference (minutes) between a requested time and
+            a frame used for it.
+        fill_value : float, optional
+            Value used for requested times that have no frame within max_skew.
+
+        Returns
+        =======
+        img_array : array
+            Image array with shape (len(targtimes), rows, columns); float32
+            for linear blends, the data type of the file for nearest frames
+        lat : float
+            Latitude array
+        lon : float
+            Longitude array
+        skew : array
+            Largest time difference (seconds) between each requested time and
+            the frames used for it (NaN for missing images)
+        """
+        if method not in ('nearest','linear'):
+            raise ValueError('Unknown time alignment method {}.'.format(method))
+
+        # calibrations are calculated before taking the file lock, which reading a whole night would hold
+        calibration = self.calibration_arrays(filename) if self.calibrate else None
+
+        # hold the lock so another thread can't close the file while it is being read
+        with self._file_lock:
+            entry = self.open_datafile(filename)
+            dataset = entry['images']
+
+            epoch = dt.datetime.utcfromtimestamp(0)
+            tstmp0 = np.array([(t-epoch).total_seconds() for t in targtimes])
+            tstmp = entry['time']
+            n = len(tstmp)
+
+            # frames before and after each requested time (Time is sorted), and their distance from it
+            after = np.searchsorted(tstmp,tstmp0)
+            before = np.clip(after-1,0,n-1)
+            after = np.clip(after,0,n-1)
+            dist_before = np.where(tstmp[before]<=tstmp0,tstmp0-tstmp[before],np.inf)
+            dist_after = np.where(tstmp[after]>=tstmp0,tstmp[after]-tstmp0,np.inf)
+            use_before = dist_before<=max_skew*60.
+            use_after = dist_after<=max_skew*60.
+
+            weight = np.zeros(len(tstmp0))
+            if method == 'linear':
+                # blend where both bracketing frames are close enough, otherwise use the one that is
+                both = use_before & use_after & (after != before)
+                first = np.where(use_before,before,after)
+                second = np.where(both,after,first)
+                weight[both] = dist_before[both]/(dist_before[both]+dist_after[both])
+                skew = np.where(both,np.maximum(dist_before,dist_after),np.minimum(dist_before,dist_after))
+            else:
+                # ties go to the earlier frame, as in read_datafile_range
+                first = np.where(dist_after<dist_before,after,before)
+                second = first
+                skew = np.minimum(dist_before,dist_after)
+            valid = use_before | use_after
+            skew[~valid] = np.nan
+
+            if not np.any(valid):
+                raise ValueError('Requested times not included in {}'.format(os.path.basename(filename)))
+
+            # read all frames that are needed with one contiguous read
+            start = min(first[valid].min(),second[valid].min())
+            stop = max(first[valid].max(),second[valid].max())+1
+            if isinstance(dataset, np.ndarray):
+                buffer = dataset[start:stop]
+            else:
+                buffer = np.empty((stop-start,)+dataset.shape[1:], dtype=dataset.dtype)
+                dataset.read_direct(buffer, np.s_[start:stop], np.s_[0:stop-start])
+            instrument.count('hdf5_bytes_read', buffer.nbytes)
+            if calibration is not None:
+                buffer = self.calibrate_images(buffer,calibration)
+
+            first = first[valid]-start
+            second = second[valid]-start
+            if method == 'linear':
+                dtype = np.result_type(np.float32,fill_value)
+                w = weight[valid].astype(np.float32)[:,None,None]
+                frames = buffer[first].astype(dtype)
+                frames *= 1-w
+                frames += buffer[second]*w
+            else:
+                dtype = np.result_type(buffer.dtype,fill_value)
+                frames = buffer[first]
+
+            if np.all(valid):
+                img_array = frames.astype(dtype,copy=False)
+            else:
+                img_array = np.full((len(tstmp0),)+buffer.shape[1:], fill_value, dtype=dtype)
+                img_array[valid] = frames
+
+            return img_array, entry['lat'], entry['lon'], skew
+
+    @instrument.timed('read_datafile_range')
+    def read_datafile_range(self,filename,targtimes,fill_value=None):
+        """
+        Helper function for getting data at many times; reads the frames closest
+        to each requested time from a single hdf5 file.  Frame indices are
+        coalesced into contiguous runs so each run is read with one hyperslab read.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+        targtimes : list of datetime objects
+            Times of images as requested by user
+        fill_value : float, optional
+            Value used for requested times that have no image within 5 minutes.
+            If not given, a ValueError is raised for such times.
+
+        Returns
+        =======
+        img_array : array
+            Image array with shape (len(targtimes), rows, columns)
+        lat : float
+            Latitude array
+        lon : float
+            Longitude array
+        truetime : list of datetime objects
+            Times images were taken (None for missing images)
+        """
+        # calibrations are calculated before taking the file lock, which reading a whole night would hold
+        calibration = self.calibration_arrays(filename) if self.calibrate else None
+
+        # hold the lock so another thread can't close the file while it is being read
+        with self._file_lock:
+            entry = self.open_datafile(filename)
+            dataset = entry['images']
+
+            epoch = dt.datetime.utcfromtimestamp(0)
+            tstmp0 = np.array([(t-epoch).total_seconds() for t in targtimes])
+            tstmp = entry['time']
+
+            # index of the closest frame to each requested time (Time is sorted)
+            if len(tstmp) > 1:
+                t = np.clip(np.searchsorted(tstmp,tstmp0),1,len(tstmp)-1)
+                t -= (tstmp0-tstmp[t-1]) <= (tstmp[t]-tstmp0)
+            else:
+                t = np.zeros(len(tstmp0),dtype=int)
+
+            # flag times where the closest frame is more than 5 minutes away
+            valid = np.abs(tstmp[t]-tstmp0)<=5.*60.
+            if fill_value is None and not np.all(valid):
+                missing = ', '.join('{:%H:%M:%S}'.format(targ) for targ, v in zip(targtimes,valid) if not v)
+                raise ValueError('Requested times {} not included in {}'.format(missing,os.path.basename(filename)))
+
+            # read each contiguous run of frames with a single read
+            frames, inverse = np.unique(t[valid], return_inverse=True)
+            buffer = np.empty((len(frames),)+dataset.shape[1:], dtype=dataset.dtype)
+            runs = np.split(np.arange(len(frames)), np.flatnonzero(np.diff(frames)!=1)+1)
+            for run in runs:
+                if not len(run):
+                    continue
+                source = np.s_[frames[run[0]]:frames[run[-1]]+1]
+                dest = np.s_[run[0]:run[-1]+1]
+                if isinstance(dataset, np.ndarray):
+                    buffer[dest] = dataset[source]
+                else:
+                    dataset.read_direct(buffer, source, dest)
+            instrument.count('hdf5_bytes_read', buffer.nbytes)
+            if calibration is not None:
+                buffer = self.calibrate_images(buffer,calibration)
+
+            if np.all(valid) and np.array_equal(inverse, np.arange(len(t))):
+                img_array = buffer
+            elif fill_value is None:
+                img_array = buffer[inverse.ravel()]
+            else:
+                img_array = np.full((len(t),)+buffer.shape[1:], fill_value, dtype=np.result_type(buffer.dtype,fill_value))
+                img_array[valid] = buffer[inverse.ravel()]
+
+            truetime = [dt.datetime.utcfromtimestamp(ts) if v else None for ts, v in zip(tstmp[t],valid)]
+
+            return img_array, entry['lat'], entry['lon'], truetime
+
+    def get_calibration(self,filename):
+        """
+        Background and scale of every pixel of a data file, calculated over all
+        of its images.  Calibrations are saved next to the data file, so they
+        are only calculated once (or again if the data file changes), and kept
+        with the open file so they are only loaded once.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+
+        Returns
+        =======
+        background : array
+            Background (mean) of each pixel.
+        scale : array
+            Scale (standard deviation) of each pixel.
+
+        """
+        return self.calibration_arrays(filename)[:2]
+
+    def calibration_arrays(self,filename):
+        """
+        Helper function for reading data; the calibration of a data file,
+        loaded or calculated if it isn't kept with the open file yet.  The
+        night of images is read with a separate file handle and without
+        holding the file lock, so other files can be read in the meantime;
+        only threads that need the same calibration wait for it.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+
+        Returns
+        =======
+        calibration : tuple
+            Background, scale and inverse scale (float32, zero where the scale
+            is zero) of each pixel.
+
+        """
+        with self._file_lock:
+            entry = self.open_datafile(filename)
+            if 'calibration' in entry:
+                return entry['calibration']
+
+        with self._locks_lock:
+            lock = self._calibration_locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+        with lock:
+            # another thread may have calculated it while we waited for the lock
+            with self._file_lock:
+                entry = self.open_datafile(filename)
+                if 'calibration' in entry:
+                    return entry['calibration']
+                mtime = entry['mtime']
+
+            background, scale = load_calibration(filename, mtime)
+            if background is None:
+                with h5py.File(filename, 'r') as f:
+                    background, scale, count = night_statistics(f['ImageData'])
+                try:
+                    save_calibration(filename, mtime, background, scale, count)
+                except (OSError, IOError) as e:
+                    # the calibration can still be used, it just isn't saved
+                    print('Unable to save calibration of {}: {}'.format(os.path.basename(filename), str(e)))
+
+            with np.errstate(divide='ignore'):
+                # pixels that never change are calibrated to zero
+                inv_scale = np.where(scale>0., 1./scale, 0.).astype(np.float32)
+            calibration = (background.astype(np.float32), scale, inv_scale)
+
+            with self._file_lock:
+                entry = self.open_datafile(filename)
+                # keep it with the open file, unless the file changed in the meantime
+                if entry['mtime'] == mtime:
+                    entry['calibration'] = calibration
+            return calibration
+
+    def calibrate_images(self,images,calibration):
+        """
+        Helper function for reading data; calibrates images read from a data file.
+
+        Parameters
+        ==========
+        images : array
+            Image, or images with shape (frames, rows, columns).
+        calibration : tuple
+            Calibration of the data file, as returned by calibration_arrays.
+
+        Returns
+        =======
+        calibrated : array
+            (images-background)/scale as float32.
+
+        """
+        background, __, inv_scale = calibration
+        calibrated = np.subtract(images, background, dtype=np.float32)
+        calibrated *= inv_scale
+        return calibrated
+
+    def open_datafile(self,filename):
+        """
+        Helper function for reading data; returns a cached open hdf5 file along
+        with its decoded Time, Latitude and Longitude arrays.  Files are
+        reopened if they have been modified since they were cached, and the
+        least recently used file is closed once more than max_open_files
+        are open.
+
+        How ImageData is accessed is chosen for each file: uncompressed,
+        contiguous datasets are memory mapped (if use_memmap is set), and
+        chunked datasets get a chunk cache large enough to hold a whole frame
+        so reading consecutive frames doesn't decompress chunks repeatedly.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+
+        Returns
+        =======
+        entry : dict
+            Dictionary with the open h5py file ('file'), its modification
+            time ('mtime'), the read-only 'time', 'lat' and 'lon' arrays and
+            the image data ('images', an h5py dataset or numpy memmap).
+        """
+        with self._file_lock:
+            mtime = os.path.getmtime(filename)
+
+            entry = self._open_files.pop(filename, None)
+            if entry is not None and entry['mtime'] != mtime:
+                # file has changed on disk since it was cached
+                entry['file'].close()
+                entry = None
+
+            if entry is None:
+                instrument.count('file_cache_misses')
+                file = h5py.File(filename, 'r')
+                entry = {'file':file, 'mtime':mtime}
+                for key, dataset in [('time','Time'),('lat','Latitude'),('lon','Longitude')]:
+                    entry[key] = file[dataset][:]
+                    # cached arrays are shared between reads
+                    entry[key].flags.writeable = False
+                    instrument.count('hdf5_bytes_read', entry[key].nbytes)
+                self.image_access(filename, entry)
+            else:
+                instrument.count('file_cache_hits')
+
+            # most recently used files are kept at the end
+            self._open_files[filename] = entry
+            while len(self._open_files) > max(self.max_open_files,1):
+                __, old = self._open_files.popitem(last=False)
+                old['file'].close()
+
+            return entry
+
+    def image_access(self,filename,entry):
+        """
+        Helper function for reading data; chooses how ImageData is read from
+        an open data file.  Uncompressed, contiguous datasets are exposed as a
+        read-only numpy memmap, so frames are read straight from the page cache
+        without going through hdf5.  Chunked datasets are opened with a chunk
+        cache big enough to hold all chunks of one frame.
+
+        Parameters
+        ==========
+        filename : str
+            hdf5 filename
+        entry : dict
+            File cache entry, as returned by open_datafile.  The 'images' key
+            is set in place.
 
-    def fetch_datafile(self, site, date, save_directory=None):
+        """
+        dataset = entry['file']['ImageData']
+        entry['images'] = dataset
+
+        if dataset.chunks is None:
+            offset = dataset.id.get_offset()
+            if self.use_memmap and offset is not None and dataset.id.get_create_plist().get_external_count() == 0:
+                entry['images'] = np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+            return
+
+        # chunks needed to cover a single frame
+        chunk_bytes = int(np.prod(dataset.chunks))*dataset.dtype.itemsize
+        chunks_per_frame = int(np.prod([-(-n//c) for n, c in zip(dataset.shape[1:],dataset.chunks[1:])]))
+        cache_bytes = chunk_bytes*chunks_per_frame
+
+        # open the dataset with its own chunk cache if the current one is too small
+        if cache_bytes > dataset.id.get_access_plist().get_chunk_cache()[1]:
+            dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+            dapl.set_chunk_cache(max(521,chunks_per_frame*100+1), cache_bytes, 0.75)
+            entry['images'] = h5py.Dataset(h5py.h5d.open(entry['file'].id, b'ImageData', dapl))
+
+    @instrument.timed('fetch_datafile', site=True)
+    def fetch_datafile(self, site, date, save_directory=None, downloader=None):
         """
         Fetches mango data from online repository.
         Curtesy of AReimer's url_fetcher() function.
@@ -195,8 +926,14 @@ class Mango(object):
             Date image was taken.
         save_directory : str, optional
             Directory where files will be saved.
+        downloader : FTPDownloader, optional
+            Downloader whose FTP sessions are reused.  A new FTP session is
+            opened (and closed) if not given.
 
         """
+        # don't ask the server for data from sites that weren't operating
+        if not self.sites.operational(site,date):
+            raise ValueError('No data available for {} on {}.'.format(site['name'],date))
 
         # make sure save directory exists
         if not save_directory:
@@ -219,33 +956,96 @@ class Mango(object):
         filename = '{0}{1:%b%d%y}.h5'.format(site['code'],date)
         output_filename = os.path.join(save_directory,filename)
 
-        # if file already exists, return without downloading anything
-        if os.path.exists(output_filename):
-            print('Already have datafile {}'.format(output_filename))
-            return
+        # only one thread downloads each file; the others wait for it and then find the file
+        with self.download_lock(output_filename):
+            # if file already exists, return without downloading anything
+            if os.path.exists(output_filename):
+                print('Already have datafile {}'.format(output_filename))
+                return
 
-        # connect to ftp server
-        ftp = ftplib.FTP('isr.sri.com')
-        ftp.login()
-        ftp_path = '/pub/earthcube/provider/asti/MANGOProcessed/{0}/{1:%b%d%y}/{2}{1:%b%d%y}.h5'.format(site['name'],date,site['code'])
+            ftp_path = '/pub/earthcube/provider/asti/MANGOProcessed/{0}/{1:%b%d%y}/{2}{1:%b%d%y}.h5'.format(site['name'],date,site['code'])
 
-        try:
-            # try to download file from ftp server
-            with open(output_filename, 'wb') as f:
-                ftp.retrbinary('RETR {}'.format(ftp_path), f.write)
-            # check to make sure file was sucessfully downloaded
-            if os.path.getsize(output_filename) == ftp.size(ftp_path):
+            # connect to ftp server
+            close_downloader = downloader is None
+            if close_downloader:
+                downloader = FTPDownloader(self.ftp_host, self.ftp_port)
+
+            try:
+                # download to a temporary file, which is renamed once its size has been checked
+                downloader.download(ftp_path, output_filename)
                 print('Sucessfully downloaded {}'.format(filename))
-            else:
-                raise_from(ValueError('Problem downloading {}'.format(filename)), None)
-        except ftplib.error_perm:
-            # if file does not exist, delete empty file and directory that were created and raise error
-            os.remove(output_filename)
-            if directory_created:
-                os.rmdir(save_directory)
-            raise_from(ValueError('No data available for {} on {}.'.format(site['name'],date)), None)
+            except ftplib.error_perm:
+                # if file does not exist, delete directory that was created and raise error
+                if directory_created and not os.listdir(save_directory):
+                    os.rmdir(save_directory)
+                raise ValueError('No data available for {} on {}.'.format(site['name'],date)) from None
+            except (ftplib.Error, EOFError, OSError, IOError) as e:
+                raise ValueError('Problem downloading {}'.format(filename)) from e
+            finally:
+                if close_downloader:
+                    downloader.close()
+
+    def download_lock(self, filename):
+        """
+        Lock held while a data file is downloaded, so threads that need the
+        same file don't download it at the same time.
+
+        Parameters
+        ==========
+        filename : str
+            Output filename of the download.
+
+        Returns
+        =======
+        lock : threading.Lock
+            Lock of this file.
+
+        """
+        with self._locks_lock:
+            return self._download_locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+    @instrument.timed('fetch_range')
+    def fetch_range(self, sites, start_date, end_date, workers=4):
+        """
+        Fetches mango data for several sites and days from online repository,
+        downloading several files at once over a pool of reused FTP sessions.
+
+        Parameters
+        ==========
+        sites : list
+            List of site dictionaries (as returned by get_site_info).
+        start_date : datetime object
+            First date to download.
+        end_date : datetime object
+            Last date to download.
+        workers : int, optional
+            Number of simultaneous downloads.  Defaults to 4.
 
-        ftp.quit()
+        Returns
+        =======
+        failed : list
+            List of (site name, date) tuples that could not be downloaded.
+
+        """
+        if isinstance(sites, dict):
+            sites = [sites]
+        dates = [start_date+dt.timedelta(days=i) for i in range((end_date-start_date).days+1)]
+        # days when a site wasn't operating are skipped without asking the server
+        files = [(site,date) for site in sites for date in dates if self.sites.operational(site,date)]
+
+        failed = []
+        with FTPDownloader(self.ftp_host, self.ftp_port, sessions=workers) as downloader:
+            with ThreadPoolExecutor(workers) as executor:
+                futures = {executor.submit(self.fetch_datafile, site, date, downloader=downloader):(site['name'],date) for site, date in files}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except ValueError as e:
+                        print('Exception: {}'.format(str(e)))
+                        instrument.failure('fetch_datafile', futures[future][0], e)
+                        failed.append(futures[future])
+
+        return failed
 
 
     def get_site_info(self,sites):
@@ -264,19 +1064,8 @@ class Mango(object):
             List of dictionaries with information about sites.
 
         """
-        # create site list from the site file and user input
-        sitefile = os.path.join(self.mangopy_path,'SiteInformation.csv')
-
-        site_list = []
-        with open(sitefile,'r') as f:
-            next(f)         # skip header line
-            reader = csv.reader(f)
-            for row in reader:
-                site_list.append({'name':row[0],'code':row[1],'lon':float(row[2]),'lat':float(row[3])})
-
-        # if particular sites are given, only include those sites in the site list
-        if sites != 'all':
-            site_list = [s for s in site_list if s['name'] in sites]
+        # create site list from the site registry and user input
+        site_list = self.sites.select(sites)
 
         if len(site_list) == 1:
             return site_list[0]
@@ -2,24 +2,29 @@
 # create mosaic plot from multiple MANGO sites
 #
 # created 2019-03-13 by LLamarche
-# - site regridding is stored in regrid_image_index.h5
-#   - this file can be removed, but it will be recreated
-#     every time the program is run
+# - site regridding indices, blending weights (and optionally the site hierarchy)
+#   are stored in the cache directory (see cache.py)
+#   - these files can be removed, but they will be recreated
+#     the next time they are needed
+# - matplotlib, cartopy and scipy are only imported by the methods that use them
 
 
 import numpy as np
-import h5py
-import matplotlib.pyplot as plt
-try:
-    import cartopy.crs as ccrs
-    import cartopy.feature as cfeature
-except ImportError:
-    print('WARNING: cartopy is not installed')
-from scipy import interpolate
 import os
+import sys
+import subprocess
 import datetime as dt
-from scipy.spatial import ConvexHull
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from .mango import Mango
+from .cache import RegridCache
+from .grid import GridSpec
+from .export import PyramidWriter, CubeWriter, valid_data
+from .render import RasterRenderer, write_png
+from . import instrument
 
 
 class Mosaic(Mango):
@@ -32,18 +37,139 @@ class Mosaic(Mango):
         Sites to be plotted as mosaic on map.
     datadir : str, optional
         Path to exisiting directory containing MANGO data.
+    save_hierarchy : bool, optional
+        If True, the site hierarchy is saved to (and loaded from) the
+        cache directory so it is only calculated once for each
+        combination of sites and grid.
+    cache_dir : str, optional
+        Path to directory where regridding indices are cached.
+    hierarchy_levels : int, optional
+        Number of closest sites kept in the site hierarchy for each grid
+        cell.  Fewer levels use less memory, but cells are left empty if
+        none of their closest sites have data.  Defaults to all sites.
+    grid_spec : GridSpec, optional
+        Extent and resolution of the background grid.  Defaults to the
+        continental US at 0.02 x 0.03 degrees.
+    dtype : data type, optional
+        Data type of mosaics.  None keeps the data type of the site images
+        (e.g. uint16 counts), which needs a fill_value that isn't NaN.
+        Defaults to float64.
+    fill_value : float, optional
+        Value of mosaic cells without data.  It should be a value that never
+        occurs in images (e.g. 65535 for 12 bit counts).  Defaults to NaN.
+    site_file : str, optional
+        csv file of sites that extend or replace the sites in
+        SiteInformation.csv (see sites.py).
+    calibrate : bool, optional
+        If True, site images are calibrated for the background and scale of
+        each site and night before they are combined (see Mango).  Needs a
+        floating point dtype (or None).
+    blend : bool, optional
+        If True, images are blended where fields of view overlap, weighted by
+        the distance of each grid cell from the cameras, instead of showing
+        only the closest site in every cell.  Defaults to False.
+    download_data : bool, optional
+        If True, downloads missing data files from ftp server.
+    max_open_files : int, optional
+        Maximum number of data files kept open between reads (see Mango).
+    use_memmap : bool, optional
+        If True, image data in uncompressed, contiguous data files is read
+        through a read-only memory map (see Mango).
 
     """
 
-    def __init__(self,sites='all',datadir=None):
+    # sites farther than this (km) from the background grid can't have any
+    # image cells on it, so they are left out of the mosaic; sites that are closer
+    # but whose field of view still misses the grid are skipped when reading images
+    fov_radius = 2000.
+
+    def __init__(self,sites='all',datadir=None,save_hierarchy=False,cache_dir=None,hierarchy_levels=None,grid_spec=None,
+                 dtype=np.float64,fill_value=np.nan,site_file=None,blend=False,
+                 calibrate=False,download_data=False,max_open_files=16,use_memmap=True):
+
+        super(Mosaic, self).__init__(datadir=datadir,download_data=download_data,max_open_files=max_open_files,
+                                     use_memmap=use_memmap,site_file=site_file,calibrate=calibrate)
+
+        if dtype is not None and np.issubdtype(dtype,np.integer) and np.isnan(fill_value):
+            raise ValueError('Mosaics of type {} need a fill_value other than NaN.'.format(np.dtype(dtype)))
+        if dtype is not None and np.issubdtype(dtype,np.integer) and calibrate:
+            # calibrated images are signed and mostly between -5 and 5
+            raise ValueError('Calibrated mosaics need a floating point data type, not {}.'.format(np.dtype(dtype)))
+        self.dtype = dtype
+        self.fill_value = fill_value
+        self.blend = blend
+
+        if grid_spec is None:
+            # default map view of the continental US
+            grid_spec = GridSpec(map_center=(40.,255.),map_extent=(235.,285.,20.,52.))
+        self.grid_spec = grid_spec
+
+        site_list = self.sites.select(sites)
+        self.site_list = [site for site in site_list if grid_spec.distance(site['lat'],site['lon'])<=self.fov_radius]
+
+        self.save_hierarchy = save_hierarchy
+        self.hierarchy_levels = hierarchy_levels
+        self.cache = RegridCache(cache_dir)
+        self._grid_key = None
+
+        # background grid, cell edges and site hierarchy are calculated on first use
+        self._grid = None
+        self._edges = None
+        self._hierarchy = None
+
+        # compiled gather and blend plans, keyed by the set of sites with data,
+        # along with the regridding keys of those sites they were compiled for
+        self._gather_plans = {}
+        self._plan_hierarchy = None
+        self._blend_plans = {}
+        self._regrid_keys = {}
+        # whether the field of view of a site covers any grid cells, keyed by regridding key
+        self._site_coverage = {}
+
+        # raster renderers, keyed by colormap and resolution
+        self._renderers = {}
+
+
+    @property
+    def grid(self):
+        """
+        Base background grid, created on first use.
+
+        """
+        if self._grid is None:
+            self._grid, self._edges = self.generate_grid()
+        return self._grid
+
+    @property
+    def edges(self):
+        """
+        Cell edges of the base background grid, created on first use.
+
+        """
+        if self._edges is None:
+            self._grid, self._edges = self.generate_grid()
+        return self._edges
+
+    @property
+    def hierarchy(self):
+        """
+        Site hierarchy for the base background grid, calculated on first use.
+        Blended mosaics don't use a hierarchy, so it is None for them.
 
-        super(Mosaic, self).__init__(datadir=datadir)
-        self.site_list = self.get_site_info(sites)
+        """
+        if self.blend:
+            return None
+        if self._hierarchy is None:
+            if self.save_hierarchy:
+                self._hierarchy = self.load_hierarchy(self.grid)
+            else:
+                self._hierarchy = self.site_hierarchy(self.grid)
+        return self._hierarchy
 
 
     def generate_grid(self):
         """
-        Create base background grid.
+        Create base background grid, as defined by grid_spec.
         Original images have the following approximate resolution:\n
         lat_res ~ 0.025 degrees\n
         lon_res ~ 0.035 degrees\n
@@ -51,38 +177,24 @@ class Mosaic(Mango):
         Returns
         =======
         grid_array : array
-            Array of grid latitude and longitude values.
+            Array of grid longitude and latitude values.
         edge_array : array
-            Array of edge latitude and longitude values.
+            Array of edge longitude and latitude values.
 
         """
-
-        latmin = 25.
-        latmax = 55.
-        latstp = 0.02
-        # latstp = 1.
-        lonmin = 225.
-        lonmax = 300.
-        lonstp = 0.03
-        # lonstp = 1.
-        lat_arr = np.arange(latmin,latmax,latstp)
-        lon_arr = np.arange(lonmin,lonmax,lonstp)
-
-        grid_lon, grid_lat = np.meshgrid(lon_arr,lat_arr)
-        edge_lon, edge_lat = np.meshgrid(np.arange(lonmin-0.5*lonstp,lonmax,lonstp),np.arange(latmin-0.5*latstp,latmax,latstp))
-
-        grid_array = np.array([grid_lon, grid_lat])
-        edge_array = np.array([edge_lon, edge_lat])
-        # return flat_grid
-        return grid_array, edge_array
+        return self.grid_spec.grid()
 
 
+    @instrument.timed('site_hierarchy')
     def site_hierarchy(self,grid_points):
         """
         Calculates site hierarchy for common grid based on the
         distance of each point from each site.  Site hierarchy
         is used to determine which camera to plot in each cell
-        of the mosaic.
+        of the mosaic.  Distances to all sites are calculated at once
+        in float32 for blocks of grid rows, and only the closest
+        hierarchy_levels sites are kept for each cell, so memory use
+        doesn't grow with the size of the grid times the number of sites.
 
         Parameters
         ==========
@@ -95,17 +207,81 @@ class Mosaic(Mango):
             Array containing hierarchy of sites.
 
         """
-        grid_distance = []
-        for site in self.site_list:
-            dist = self.haversine(site['lat'],site['lon'],grid_points[1],grid_points[0])
-            grid_distance.append(dist)
-        grid_distance = np.array(grid_distance)
-
-        hierarchy = np.argsort(grid_distance,axis=0)
+        num_sites = len(self.site_list)
+        levels = num_sites if self.hierarchy_levels is None else min(self.hierarchy_levels,num_sites)
+
+        site_lat, site_lon = self.sites.coordinates(self.site_list)
+        site_lat = site_lat.astype(np.float32)[:,None,None]
+        site_lon = site_lon.astype(np.float32)[:,None,None]
+
+        # the smallest type that holds all site indices (uint8 for up to 256 sites) is much smaller than argsort's int64
+        hierarchy = np.empty((levels,)+grid_points[0].shape,dtype=np.min_scalar_type(max(num_sites-1,0)))
+        if num_sites == 0:
+            # no sites near the grid; every cell of the mosaic is empty
+            return hierarchy
+
+        # limit the distance array for each block of rows to ~8 MB
+        nrows, ncols = grid_points[0].shape
+        block = max(1,2**21//(num_sites*ncols))
+        for r in range(0,nrows,block):
+            grid_lat = grid_points[1,r:r+block].astype(np.float32)
+            grid_lon = grid_points[0,r:r+block].astype(np.float32)
+            grid_distance = self.haversine(site_lat,site_lon,grid_lat,grid_lon)
+
+            if levels < num_sites:
+                # find the closest sites without sorting all of them
+                closest = np.argpartition(grid_distance,levels-1,axis=0)[:levels]
+                order = np.argsort(np.take_along_axis(grid_distance,closest,axis=0),axis=0)
+                hierarchy[:,r:r+block] = np.take_along_axis(closest,order,axis=0)
+            else:
+                hierarchy[:,r:r+block] = np.argsort(grid_distance,axis=0)
 
         return hierarchy
 
 
+    def load_hierarchy(self,grid_points):
+        """
+        Loads the site hierarchy for the common grid from the cache directory,
+        calculating and saving it first if it is not already there.  Entries
+        are keyed by the sites and the grid they were calculated for.
+
+        Parameters
+        ==========
+        grid_points : array
+            Coordinate points of base background grid.
+
+        Returns
+        =======
+        hierarchy : array
+            Array containing hierarchy of sites.
+
+        """
+        sites = [(site['name'],site['lat'],site['lon']) for site in self.site_list]
+        key = self.cache.key(self.grid_key(grid_points), sites, self.hierarchy_levels)
+        return self.cache.get('hierarchy', key, lambda: self.site_hierarchy(grid_points))
+
+
+    def grid_key(self,grid_points):
+        """
+        Cache key for a background grid.  The key for the most recently
+        used grid is remembered so large grids are only hashed once.
+
+        Parameters
+        ==========
+        grid_points : array
+            Coordinate points of base background grid.
+
+        Returns
+        =======
+        key : str
+            Cache key of grid.
+
+        """
+        if self._grid_key is None or self._grid_key[0] is not grid_points:
+            self._grid_key = (grid_points, self.cache.key(grid_points))
+        return self._grid_key[1]
+
+
     def haversine(self,lat0,lon0,lat,lon):
         """
         Calculates distance (in km) between two points on Earth,
@@ -145,9 +321,71 @@ class Mosaic(Mango):
         return km
 
 
+    def regrid_key(self,site,background_grid,time):
+        """
+        Cache key of the regridding indices of a site, from the background grid
+        and the site's latitude and longitude arrays.  Keys are remembered for
+        each data file, so the arrays are only hashed once.
+
+        Parameters
+        ==========
+        site : str
+            Site for which you need the key.
+        background_grid : array
+            Base background grid.
+        time : datetime object
+            Time of image as requested by user.
+
+        Returns
+        =======
+        key : str
+            Cache key.
+
+        """
+        lat, lon = self.get_coordinates(site,time)
+        filename = self.datafile_name(site,time)
+
+        # the coordinate arrays are kept with the open file, and are new arrays if the file is reopened
+        known = self._regrid_keys.get(filename)
+        if known is None or known[0] is not background_grid or known[1] is not lat:
+            known = (background_grid, lat, self.cache.key(self.grid_key(background_grid), lat, lon))
+            self._regrid_keys[filename] = known
+        return known[2]
+
+
+    def covers_grid(self,site,background_grid,time):
+        """
+        Whether the field of view of a site covers any cell of a background
+        grid, so images of sites that can't appear on the mosaic aren't read.
+        The answer is remembered for each grid and camera geometry.
+
+        Parameters
+        ==========
+        site : str
+            Camera site.
+        background_grid : array
+            Base background grid.
+        time : datetime object
+            Time (or date) of images.
+
+        Returns
+        =======
+        covers : bool
+            True if the site's images cover at least one grid cell.
+
+        """
+        key = self.regrid_key(site,background_grid,time)
+        if key not in self._site_coverage:
+            self._site_coverage[key] = bool(np.any(self.get_nearest_index(site,background_grid,time)>=0))
+        return self._site_coverage[key]
+
+
+    @instrument.timed('get_nearest_index', site=True)
     def get_nearest_index(self,site,background_grid,time):
         """
         Gets nearest neighbor interpolation indices for the specifed site.
+        Indices are cached, keyed by the background grid and the site's
+        latitude and longitude arrays.
 
         Parameters
         ==========
@@ -161,65 +399,173 @@ class Mosaic(Mango):
         Returns
         =======
         nearest_idx : array
-            Nearest index of each image cell closest to grid cell.
+            Nearest index of each image cell closest to grid cell
+            (-1 for grid cells outside the camera field of view).
 
         """
+        key = self.regrid_key(site,background_grid,time)
+        return self.cache.get(site['name'], key, lambda: self.calculate_nearest_index(site,background_grid,*self.get_coordinates(site,time)))
 
 
-        rewrite_file = False
-        regrid_file = os.path.join(self.mangopy_path,'regrid_image_index.h5')
-        if rewrite_file:
-            os.remove(regrid_file)
+    @instrument.timed('calculate_nearest_index', site=True)
+    def calculate_nearest_index(self,site,background_grid,lat,lon):
+        """
+        Calculates nearest neighbor interpolation indices for the specifed site.
+        Distances are measured between 3D unit vectors, so they are not distorted
+        at high latitudes or across the longitude wrap.  A grid cell is in the
+        field of view if the closest image cell is no farther from it than that
+        image cell is from its neighbors in the image, which also works for
+        fields of view that are not convex.
 
-        try:
-            with h5py.File(regrid_file,'r') as f:
-                nearest_idx = f[site['name']][:]
-        except:
-
-            flat_grid = np.array([background_grid[0].ravel(),background_grid[1].ravel()]).T
-            lon_arr = background_grid[0,0,:]
-            lat_arr = background_grid[1,:,0]
-
-            # get site lat/lon arrays
-            __, lat, lon, __ = self.get_data(site,time)
-
-            flat_lat = lat.ravel()
-            flat_lon = lon.ravel()
-            flat_idx = np.arange(len(flat_lat))
-
-            flat_idx = flat_idx[np.isfinite(flat_lat)]
-            flat_lon = flat_lon[np.isfinite(flat_lat)]
-            flat_lat = flat_lat[np.isfinite(flat_lat)]
-            flat_points = np.array([flat_lon,flat_lat]).T
-
-            fov = flat_points[ConvexHull(flat_points).vertices].T
-            # print(fov)
-            center_lon = site['lon']
-            if center_lon<0:
-                center_lon += 360.
-            # find points west of site
-            fovW = fov[:,fov[0,:]<center_lon]
-            # find points east of site
-            fovE = fov[:,fov[0,:]>center_lon]
-            # find longitude limits for each latitude row in the grid
-            limits = []
-            for f in [fovW,fovE]:
-                f = f[:,np.argsort(f[1,:])]
-                limits.append(np.interp(lat_arr,f[1,:],f[0,:],left=np.nan,right=np.nan))
-            # create flag array identifying points in grid within fov
-            flags = np.all(np.array([lon_arr>=limits[0][:,None],lon_arr<=limits[1][:,None]]),axis=0)
-
-            # find index of image cell that is closest to each grid cell in the fov
-            nearest_idx = np.full(background_grid[0].shape,np.nan)
-            nearest_idx[flags] = interpolate.griddata(flat_points,flat_idx,flat_grid[flags.ravel()],method='nearest')
-
-            with h5py.File(regrid_file, 'a') as f:
-                f.create_dataset(site['name'], data=nearest_idx, compression='gzip', compression_opts=1)
+        Parameters
+        ==========
+        site : str
+            Site for which you need indices.
+        background_grid : array
+            Base background grid.
+        lat : array
+            Latitude array of site images.
+        lon : array
+            Longitude array of site images.
+
+        Returns
+        =======
+        nearest_idx : array
+            Nearest index of each image cell closest to grid cell
+            (-1 for grid cells outside the camera field of view).
+
+        """
+        from scipy.spatial import cKDTree
+
+        flat_idx = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+
+        nearest_idx = np.full(background_grid[0].shape,-1,dtype=np.int32)
+        if len(flat_idx) < 2:
+            return nearest_idx
+
+        # size of each image cell: largest distance to its neighbors in the image
+        points = self.unit_vectors(lat,lon)
+        spacing = np.full(lat.shape,np.nan)
+        for axis in [0,1]:
+            step = np.linalg.norm(np.diff(points,axis=axis),axis=-1)
+            pad = [(0,0),(0,0)]
+            for pad[axis] in [(1,0),(0,1)]:
+                spacing = np.fmax(spacing,np.pad(step,pad,constant_values=np.nan))
+        spacing = np.nan_to_num(spacing.ravel()[flat_idx])
+        max_spacing = spacing.max()
+
+        # build tree of image cell positions
+        image_points = points.reshape(-1,3)[flat_idx]
+        tree = cKDTree(image_points)
+
+        # only check grid cells within the cap around the site that contains the whole field of view
+        site_point = self.unit_vectors(site['lat'],site['lon'])
+        cap = np.arccos(np.clip(image_points.dot(site_point),-1.,1.)).max()+2*np.arcsin(max_spacing/2.)
+        grid_lat = background_grid[1].ravel()
+        grid_lon = background_grid[0].ravel()
+        cells = np.flatnonzero(np.abs(grid_lat-site['lat'])<=np.degrees(cap))
+        max_lat = min(abs(site['lat'])+np.degrees(cap),89.)
+        cells = cells[np.abs((grid_lon[cells]-site['lon']+180.)%360.-180.)<=np.degrees(cap)/np.cos(np.radians(max_lat))]
+        cos_dist = (np.sin(np.radians(grid_lat[cells]))*np.sin(np.radians(site['lat']))
+                    + np.cos(np.radians(grid_lat[cells]))*np.cos(np.radians(site['lat']))*np.cos(np.radians(grid_lon[cells]-site['lon'])))
+        cells = cells[cos_dist>=np.cos(cap)]
+
+        # find index of image cell that is closest to each grid cell in the fov
+        grid_points = self.unit_vectors(grid_lat[cells],grid_lon[cells])
+        dist, idx = tree.query(grid_points,distance_upper_bound=max_spacing,workers=-1)
+        found = idx < len(flat_idx)
+        found[found] = dist[found] <= spacing[idx[found]]
+        nearest_idx.ravel()[cells[found]] = flat_idx[idx[found]]
 
         return nearest_idx
 
 
-    def grid_mosaic(self,time,grid,hierarchy):
+    @instrument.timed('get_blend_weights', site=True)
+    def get_blend_weights(self,site,background_grid,time):
+        """
+        Gets the blending weights of the grid cells in the field of view of the
+        specified site.  Weights are cached along with the nearest neighbor
+        interpolation indices, with the same key.
+
+        Parameters
+        ==========
+        site : str
+            Site for which you need weights.
+        background_grid : array
+            Base background grid.
+        time : datetime object
+            Time of image as requested by user.
+
+        Returns
+        =======
+        weights : array
+            Weight of each grid cell in the field of view, in the order of
+            np.flatnonzero(nearest_idx>=0).
+
+        """
+        nearest_idx = self.get_nearest_index(site,background_grid,time)
+
+        key = self.regrid_key(site,background_grid,time)
+        return self.cache.get(site['name']+'_weights', key, lambda: self.calculate_blend_weights(site,background_grid,nearest_idx))
+
+
+    def calculate_blend_weights(self,site,background_grid,nearest_idx):
+        """
+        Calculates blending weights for the specified site.  Weights fall off
+        linearly with the distance of a grid cell from the camera, from one at
+        the camera to (almost) zero at the farthest cell in the field of view,
+        so images fade out towards the edges of their fields of view.
+
+        Parameters
+        ==========
+        site : str
+            Site for which you need weights.
+        background_grid : array
+            Base background grid.
+        nearest_idx : array
+            Nearest neighbor interpolation indices of the site.
+
+        Returns
+        =======
+        weights : array
+            Weight of each grid cell in the field of view, in the order of
+            np.flatnonzero(nearest_idx>=0).
+
+        """
+        cells = np.flatnonzero(nearest_idx.ravel()>=0)
+        if len(cells) == 0:
+            return np.zeros(0,dtype=np.float32)
+
+        distance = self.haversine(site['lat'],site['lon'],background_grid[1].ravel()[cells],background_grid[0].ravel()[cells])
+        radius = max(distance.max(),1.)
+        # keep a small weight at the edge, so cells where only edges overlap are still averaged
+        return np.maximum(1.-distance/radius,1e-3).astype(np.float32)
+
+
+    def unit_vectors(self,lat,lon):
+        """
+        Converts latitude and longitude to unit vectors from the center of the Earth.
+
+        Parameters
+        ==========
+        lat : array
+            Latitude (degrees).
+        lon : array
+            Longitude (degrees).
+
+        Returns
+        =======
+        points : array
+            Array of unit vectors with shape (..., 3).
+
+        """
+        lat = np.radians(lat)
+        lon = np.radians(lon)
+        return np.stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)],axis=-1)
+
+
+    @instrument.timed('grid_mosaic')
+    def grid_mosaic(self,time,grid,hierarchy,sites=None):
         """
         Creates combined grid based on hierarchy.
 
@@ -231,6 +577,10 @@ class Mosaic(Mango):
             Base background grid.
         hierarchy : array
             Hierarchy of sites to be plotted.
+        sites : array, optional
+            True for sites (in the order of site_list) known to have an image
+            at this time, e.g. a row of frame_coverage; other sites aren't read.
+            Defaults to all sites.
 
         Returns
         =======
@@ -240,47 +590,376 @@ class Mosaic(Mango):
             Time images were taken.
 
         """
-        grid_img = []
+        images, truetime = self.read_mosaic_images(time,sites,grid)
+        combined_grid = self.combine_images(images,time,grid,hierarchy)
+
+        return combined_grid, truetime
+
+
+    @instrument.timed('read_mosaic_images')
+    def read_mosaic_images(self,time,sites=None,grid=None):
+        """
+        Reads the image of every site closest to the requested time.
+
+        Parameters
+        ==========
+        time : datetime object
+            Time of images on mosaic as requested by user.
+        sites : array, optional
+            True for sites (in the order of site_list) known to have an image
+            at this time, e.g. a row of frame_coverage; other sites aren't read.
+            Defaults to all sites.
+        grid : array, optional
+            Background grid of the mosaic; sites whose field of view misses it
+            aren't read.  Defaults to the base background grid.
+
+        Returns
+        =======
+        images : dict
+            Flattened image arrays, keyed by site index (into site_list),
+            for sites that have data.
+        truetime : list
+            Time images were taken ('' for sites without data).
+
+        """
+        if grid is None:
+            grid = self.grid
+
+        images = {}
         truetime = []
-        for site in self.site_list:
+        for i, site in enumerate(self.site_list):
+
+            # sites known to have no image at this time aren't read at all
+            if sites is not None and not sites[i]:
+                truetime.append('')
+                continue
 
             # get data
             try:
-                img, __, __, tt = self.get_data(site,time)
+                # skip sites whose field of view misses the grid
+                if self.sites.operational(site,time) and not self.covers_grid(site,grid,time):
+                    truetime.append('')
+                    continue
+                img, __, __, tt = self.get_data(site,time,copy=False)
                 truetime.append(tt)
             except (OSError, IOError, ValueError) as e:
                 print('Exception: {}'.format(str(e)))
+                instrument.failure('get_data', site['name'], e)
                 truetime.append('')
-                grid_img.append(np.full(grid[0].shape,np.nan))
                 continue
 
-            flat_img = img.ravel()
+            images[i] = img.ravel()
+
+        return images, truetime
+
+
+    @instrument.timed('combine_images')
+    def combine_images(self,images,time,grid,hierarchy):
+        """
+        Combines site images on the background grid based on hierarchy.
+
+        Parameters
+        ==========
+        images : dict
+            Flattened image arrays keyed by site index, as returned by
+            read_mosaic_images.
+        time : datetime object
+            Time of images on mosaic as requested by user.
+        grid : array
+            Base background grid.
+        hierarchy : array
+            Hierarchy of sites to be plotted (None for blended mosaics).
 
-            #get nearest neighbor interpolation indices for this site
-            nearest_idx = self.get_nearest_index(site,grid,time)  # nearest index is site specific
+        Returns
+        =======
+        combined_grid : array
+            Combined grid.
 
-            #interpolate image to grid
-            img_interp = np.full(grid[0].shape,np.nan)
-            img_interp[np.isfinite(nearest_idx)] = flat_img[nearest_idx[np.isfinite(nearest_idx)].astype('int32')]
+        """
+        # get the gather plan for the sites that have data at this time
+        if self.blend:
+            plan, overlap, blends = self.blend_plan(tuple(sorted(images)),grid,time)
+        else:
+            plan = self.gather_plan(tuple(sorted(images)),grid,hierarchy,time)
+            blends = []
+
+        dtype = self.dtype
+        if dtype is None:
+            # keep the data type of the site images
+            dtype = np.result_type(*[img.dtype for img in images.values()]) if images else np.float64
+            if np.issubdtype(dtype,np.integer) and np.isnan(self.fill_value):
+                raise ValueError('Mosaics of type {} need a fill_value other than NaN.'.format(dtype))
+
+        # create combined grid of all sites with one gather per site
+        combined_grid = np.full(grid[0].size,self.fill_value,dtype=dtype)
+        for i, cells, pixels in plan:
+            combined_grid[cells] = images[i][pixels]
+        if blends:
+            # weighted sum of the sites covering each cell where fields of view overlap
+            blended = np.zeros(len(overlap),dtype=np.result_type(dtype,np.float32))
+            for i, positions, pixels, weights in blends:
+                blended[positions] += weights*images[i][pixels]
+            if np.issubdtype(dtype,np.integer):
+                blended = np.rint(blended)
+            combined_grid[overlap] = blended
+        combined_grid = combined_grid.reshape(grid[0].shape)
+
+        return combined_grid
+
+
+    def iter_mosaics(self,starttime,endtime,cadence=5,prefetch=4,workers=4):
+        """
+        Generates mosaics at regular intervals.  Site images for upcoming
+        frames are read (and downloaded, if download_data is set) by a pool
+        of background threads while the current frame is being gridded.
 
-            # add interpolated image to the list of interpolated images from all sites
-            grid_img.append(img_interp)
+        Parameters
+        ==========
+        starttime : datetime object
+            Time of first mosaic.
+        endtime : datetime object
+            Time of last mosaic.
+        cadence : float, optional
+            Time between mosaics in minutes.  Defaults to 5.
+        prefetch : int, optional
+            Maximum number of frames read ahead, which limits memory use.
+        workers : int, optional
+            Number of threads reading images.
+
+        Yields
+        ======
+        time : datetime object
+            Time of mosaic.
+        combined_grid : array
+            Combined grid.
+        truetime : list
+            Time images were taken.
 
-        grid_img = np.array(grid_img)
+        """
+        num_frames = int((endtime-starttime).total_seconds()/60./cadence)+1
+        time_list = iter([starttime+dt.timedelta(minutes=i*cadence) for i in range(num_frames)])
 
+        grid = self.grid
+        hierarchy = self.hierarchy
 
-        # create combined grid of all sites based on site hierarchy
-        grid_shape = grid[0].shape
-        combined_grid = np.full(grid_shape,np.nan)
-        J, I = np.meshgrid(np.arange(grid_shape[1]),np.arange(grid_shape[0]))
-        for lev in range(hierarchy.shape[0]):
-            nans = np.isnan(combined_grid)
-            combined_grid[nans] = grid_img[hierarchy[lev][nans].astype('int32'),I[nans],J[nans]]
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque((time, executor.submit(self.read_mosaic_images,time,None,grid)) for time in itertools.islice(time_list,max(prefetch,1)))
+            try:
+                while pending:
+                    time, future = pending.popleft()
+                    # keep the queue of frames being read full
+                    for next_time in itertools.islice(time_list,1):
+                        pending.append((next_time, executor.submit(self.read_mosaic_images,next_time,None,grid)))
 
-        return combined_grid, truetime
+                    images, truetime = future.result()
+                    yield time, self.combine_images(images,time,grid,hierarchy), truetime
+            finally:
+                # don't wait for frames that will never be used
+                for __, future in pending:
+                    future.cancel()
 
 
+    def iter_aligned_mosaics(self,starttime,endtime,cadence=5,method='linear',max_skew=5.,batch=6):
+        """
+        Generates mosaics on a common timeline, with the images of every site
+        aligned to the time of each mosaic.  Site images are read for batches
+        of frames at once, using one contiguous read per site and batch (see
+        Mango.get_data_aligned).
 
+        Parameters
+        ==========
+        starttime : datetime object
+            Time of first mosaic.
+        endtime : datetime object
+            Time of last mosaic.
+        cadence : float, optional
+            Time between mosaics in minutes.  Defaults to 5.
+        method : str, optional
+            'nearest' uses the image closest to each mosaic time, 'linear'
+            blends the two images bracketing it.  Defaults to 'linear'.
+        max_skew : float, optional
+            Largest time difference (minutes) between a mosaic and the images
+            used for it; sites without such images are left out of the mosaic.
+            Defaults to 5.
+        batch : int, optional
+            Number of frames read at once, which limits memory use.
+
+        Yields
+        ======
+        time : datetime object
+            Time of mosaic.
+        combined_grid : array
+            Combined grid.
+        skew : array
+            Largest time difference (seconds) between the mosaic and the images
+            used for it, for every site (NaN for sites without data).
+
+        """
+        num_frames = int((endtime-starttime).total_seconds()/60./cadence)+1
+        time_list = [starttime+dt.timedelta(minutes=i*cadence) for i in range(num_frames)]
+
+        grid = self.grid
+        hierarchy = self.hierarchy
+
+        for b in range(0,num_frames,max(batch,1)):
+            times = time_list[b:b+max(batch,1)]
+
+            # aligned image stacks of every site; missing frames are marked by NaN skews,
+            # so the fill value can be anything that keeps the data type of the images
+            stacks = {}
+            skews = np.full((len(times),len(self.site_list)),np.nan)
+            for i, site in enumerate(self.site_list):
+                try:
+                    # skip sites whose field of view misses the grid
+                    dates = [date for date in sorted({time.date() for time in times}) if self.sites.operational(site,date)]
+                    if not any(self.covers_grid(site,grid,date) for date in dates):
+                        continue
+                    img, __, __, skew = self.get_data_aligned(site,times,method=method,max_skew=max_skew,fill_value=0)
+                except (OSError, IOError, ValueError) as e:
+                    print('Exception: {}'.format(str(e)))
+                    instrument.failure('get_data_aligned', site['name'], e)
+                    continue
+                stacks[i] = img.reshape(len(times),-1)
+                skews[:,i] = skew
+
+            for k, time in enumerate(times):
+                images = {i:stack[k] for i, stack in stacks.items() if np.isfinite(skews[k,i])}
+                yield time, self.combine_images(images,time,grid,hierarchy), skews[k]
+
+
+    @instrument.timed('gather_plan')
+    def gather_plan(self,available,grid,hierarchy,time):
+        """
+        Compiles the site hierarchy and nearest neighbor interpolation indices
+        into a flat gather plan for a particular set of available sites.  Each
+        grid cell is assigned to the highest ranked available site whose field
+        of view covers it, so fallback to lower ranked sites is already resolved.
+        Plans are cached for each set of available sites, and recompiled when
+        the camera geometry of any of them changes (e.g. on another night).
+
+        Parameters
+        ==========
+        available : tuple
+            Indices (into site_list) of sites that have data.
+        grid : array
+            Base background grid.
+        hierarchy : array
+            Hierarchy of sites to be plotted.
+        time : datetime object
+            Time of images as requested by user.
+
+        Returns
+        =======
+        plan : list
+            List of (site index, flat grid cell indices, flat image pixel indices)
+            tuples.
+
+        """
+        if hierarchy is not self._plan_hierarchy:
+            self._gather_plans = {}
+            self._plan_hierarchy = hierarchy
+
+        keys = tuple(self.regrid_key(self.site_list[i],grid,time) for i in available)
+        if available in self._gather_plans and self._gather_plans[available][0] == keys:
+            return self._gather_plans[available][1]
+
+        # get nearest neighbor interpolation indices for available sites
+        nearest_idx = {}
+        for i in available:
+            nearest_idx[i] = self.get_nearest_index(self.site_list[i],grid,time).ravel()
+
+        # assign each cell to the first available site in the hierarchy that covers it
+        owner = np.full(grid[0].size,-1,dtype=np.int16)
+        for lev in range(hierarchy.shape[0]):
+            unset = owner<0
+            if not np.any(unset):
+                break
+            level = hierarchy[lev].ravel()
+            for i in available:
+                cells = unset & (level==i) & (nearest_idx[i]>=0)
+                owner[cells] = i
+
+        plan = []
+        for i in available:
+            cells = np.flatnonzero(owner==i).astype(np.int32)
+            if len(cells):
+                plan.append((i, cells, nearest_idx[i][cells]))
+
+        self._gather_plans[available] = (keys, plan)
+        return plan
+
+
+    @instrument.timed('blend_plan')
+    def blend_plan(self,available,grid,time):
+        """
+        Compiles the nearest neighbor interpolation indices and blending weights
+        into a blend plan for a particular set of available sites.  Cells in the
+        field of view of a single site are gathered from that site, like in a
+        gather plan, and only cells where fields of view overlap are blended,
+        with weights normalized to a sum of one.  Plans are cached for each set
+        of available sites, and recompiled when the camera geometry of any of
+        them changes.
+
+        Parameters
+        ==========
+        available : tuple
+            Indices (into site_list) of sites that have data.
+        grid : array
+            Base background grid.
+        time : datetime object
+            Time of images as requested by user.
+
+        Returns
+        =======
+        plan : list
+            List of (site index, flat grid cell indices, flat image pixel indices)
+            tuples for cells covered by a single site.
+        overlap : array
+            Flat grid cell indices of cells covered by several sites.
+        blends : list
+            List of (site index, positions in overlap, flat image pixel indices,
+            weights) tuples for cells covered by several sites.
+
+        """
+        keys = tuple(self.regrid_key(self.site_list[i],grid,time) for i in available)
+        if available in self._blend_plans and self._blend_plans[available][0] == keys:
+            return self._blend_plans[available][1]
+
+        # get interpolation indices and weights of the cells in the field of view of each site
+        covered = {}
+        nearest_idx = {}
+        weights = {}
+        coverage = np.zeros(grid[0].size,dtype=np.int16)
+        for i in available:
+            nearest_idx[i] = self.get_nearest_index(self.site_list[i],grid,time).ravel()
+            weights[i] = self.get_blend_weights(self.site_list[i],grid,time)
+            covered[i] = np.flatnonzero(nearest_idx[i]>=0)
+            coverage[covered[i]] += 1
+
+        overlap = np.flatnonzero(coverage>1).astype(np.int32)
+        total = np.zeros(len(overlap),dtype=np.float32)
+
+        plan = []
+        blends = []
+        for i in available:
+            single = coverage[covered[i]]==1
+            cells = covered[i][single].astype(np.int32)
+            if len(cells):
+                plan.append((i, cells, nearest_idx[i][cells]))
+            cells = covered[i][~single]
+            if len(cells):
+                positions = np.searchsorted(overlap,cells).astype(np.int32)
+                total[positions] += weights[i][~single]
+                blends.append((i, positions, nearest_idx[i][cells], weights[i][~single]))
+
+        # normalize weights of every cell
+        blends = [(i, positions, pixels, w/total[positions]) for i, positions, pixels, w in blends]
+
+        self._blend_plans[available] = (keys, (plan, overlap, blends))
+        return plan, overlap, blends
+
+
+    @instrument.timed('create_mosaic')
     def create_mosaic(self,time,cell_edges=False):
 
         """
@@ -304,11 +983,9 @@ class Mosaic(Mango):
 
         """
 
-        # create background grid
-        grid, edges = self.generate_grid()
-
-        # find site hierarchy for background grid
-        hierarchy = self.site_hierarchy(grid)
+        # background grid and site hierarchy are only calculated once
+        grid, edges = self.grid, self.edges
+        hierarchy = self.hierarchy
 
         # create mosaic of all sites on background grid
         combined_grid, truetime = self.grid_mosaic(time,grid,hierarchy)
@@ -323,7 +1000,133 @@ class Mosaic(Mango):
             return combined_grid, grid_lat_values, grid_lon_values
 
 
-    def plot_mosaic(self,time,dpi=300,saveFig = False):
+    def export_pyramid(self,starttime,endtime,filename,cadence=5,tile_size=256,levels=None):
+        """
+        Writes mosaics to an hdf5 file as a tiled pyramid of downsampled
+        levels (see export.py).  Each mosaic is only created once, at full
+        resolution; lower levels are averaged from it.  Frames at or before
+        the last frame already in the file are skipped, so an interrupted
+        export can be resumed.
+
+        Parameters
+        ==========
+        starttime : datetime object
+            Time of first mosaic.
+        endtime : datetime object
+            Time of last mosaic.
+        filename : str
+            hdf5 filename.
+        cadence : float, optional
+            Time between mosaics in minutes.  Defaults to 5.
+        tile_size : int, optional
+            Rows and columns of tiles.
+        levels : int, optional
+            Number of levels.  Defaults to enough levels for the smallest
+            level to fit in a single tile.
+
+        """
+        with PyramidWriter(filename,self.grid,tile_size=tile_size,levels=levels,fill_value=self.fill_value) as writer:
+            for time, combined_grid, __ in self.resume_mosaics(writer.times,starttime,endtime,cadence):
+                writer.write(time,combined_grid)
+
+
+    def export_mosaic_cube(self,starttime,endtime,cadence,filename,dtype='float32',scale=1.,offset=0.,compression='gzip'):
+        """
+        Writes mosaics to a single hdf5 dataset (time, lat, lon) chunked by
+        frame, along with the time each site's image was taken (see
+        export.py).  Frames at or before the last frame already in the file
+        are skipped, so an interrupted export can be resumed or a file can be
+        extended.
+
+        Parameters
+        ==========
+        starttime : datetime object
+            Time of first mosaic.
+        endtime : datetime object
+            Time of last mosaic.
+        cadence : float
+            Time between mosaics in minutes.
+        filename : str
+            hdf5 filename.
+        dtype : str, optional
+            Data type of stored images: 'float32', 'float16' or 'uint16'.
+        scale : float, optional
+            Quantization step of uint16 images.  Defaults to 1 (raw counts).
+        offset : float, optional
+            Value of zero in uint16 images.
+        compression : str, optional
+            hdf5 compression filter, or None for uncompressed frames.
+
+        """
+        sites = [site['name'] for site in self.site_list]
+        with CubeWriter(filename,self.grid,sites,dtype=dtype,scale=scale,offset=offset,compression=compression,
+                        fill_value=self.fill_value) as writer:
+            for time, combined_grid, truetime in self.resume_mosaics(writer.times,starttime,endtime,cadence):
+                writer.write(time,combined_grid,truetime)
+
+
+    def resume_mosaics(self,written,starttime,endtime,cadence):
+        """
+        Generates mosaics with iter_mosaics, starting after the last of the
+        frames that were already written.
+
+        Parameters
+        ==========
+        written : list
+            Times of frames already written.
+        starttime : datetime object
+            Time of first mosaic.
+        endtime : datetime object
+            Time of last mosaic.
+        cadence : float
+            Time between mosaics in minutes.
+
+        Yields
+        ======
+        time : datetime object
+            Time of mosaic.
+        combined_grid : array
+            Combined grid.
+        truetime : list
+            Time images were taken.
+
+        """
+        if written:
+            while starttime <= written[-1]:
+                starttime += dt.timedelta(minutes=cadence)
+        if starttime > endtime:
+            return
+
+        for frame in self.iter_mosaics(starttime,endtime,cadence=cadence):
+            yield frame
+
+
+    def raster_renderer(self,cmap='gray',dpi=100):
+        """
+        Renderer that draws mosaics as RGB images without matplotlib figures
+        (see render.py).  The mapping from map pixels to grid cells and the
+        map features are calculated on first use and reused for every frame.
+
+        Parameters
+        ==========
+        cmap : str, optional
+            Name of matplotlib colormap.
+        dpi : int, optional
+            Resolution of map (pixels per inch).
+
+        Returns
+        =======
+        renderer : RasterRenderer
+            Renderer for the background grid.
+
+        """
+        if (cmap,dpi) not in self._renderers:
+            self._renderers[(cmap,dpi)] = RasterRenderer(self.grid_spec,cmap=cmap,dpi=dpi,fill_value=self.fill_value)
+        return self._renderers[(cmap,dpi)]
+
+
+    @instrument.timed('plot_mosaic')
+    def plot_mosaic(self,time,dpi=300,saveFig = False,raster=False):
 
         """
         Plots images of sites closest to requested time on map with grid.
@@ -336,22 +1139,37 @@ class Mosaic(Mango):
             Defaults to 300.
         saveFig : boolean, optional
             Saves figure of mosaic if set to True.
+        raster : boolean, optional
+            If True, the map is drawn as a single image by raster_renderer
+            instead of with pcolormesh, which is much faster.
 
         """
         # get background grid image and coordinates
         img, grid_lat, grid_lon, edge_lat, edge_lon, truetime = self.create_mosaic(time, cell_edges=True)
 
-        # set up map
+        import matplotlib.pyplot as plt
+
         fig = plt.figure(figsize=(13,10))
-        map_proj = ccrs.LambertConformal(central_longitude=255.,central_latitude=40.0)
-        ax = fig.add_subplot(111,projection=map_proj)
-        ax.coastlines()
-        ax.gridlines(color='lightgrey', linestyle='-', draw_labels=True, x_inline = False, y_inline = False)
-        ax.add_feature(cfeature.STATES)
-        ax.set_extent([235,285,20,52])
+        if raster:
+            # show the pre-rendered map as an image, rendered at the resolution of the saved figure
+            ax = fig.add_subplot(111)
+            ax.imshow(self.raster_renderer('gist_heat',dpi).render(img))
+            ax.set_axis_off()
+        else:
+            import cartopy.crs as ccrs
+            import cartopy.feature as cfeature
 
-        # plot image on map
-        ax.pcolormesh(edge_lon, edge_lat, img, cmap=plt.get_cmap('gist_heat'), transform=ccrs.PlateCarree())
+            # set up map
+            map_proj = ccrs.LambertConformal(central_longitude=self.grid_spec.map_center[1],central_latitude=self.grid_spec.map_center[0])
+            ax = fig.add_subplot(111,projection=map_proj)
+            ax.coastlines()
+            ax.gridlines(color='lightgrey', linestyle='-', draw_labels=True, x_inline = False, y_inline = False)
+            ax.add_feature(cfeature.STATES)
+            ax.set_extent(self.grid_spec.map_extent)
+
+            # plot image on map
+            img = np.ma.masked_where(~valid_data(img,self.fill_value),img)
+            ax.pcolormesh(edge_lon, edge_lat, img, cmap=plt.get_cmap('gist_heat'), transform=ccrs.PlateCarree())
 
         # add target time as title of plot
         ax.set_title('{:%Y-%m-%d %H:%M}'.format(time))
@@ -366,85 +1184,382 @@ class Mosaic(Mango):
 
 
 
-    def create_all_mosaic(self, date, saveFig=False):
+    @instrument.timed('create_all_mosaic')
+    def create_all_mosaic(self, date, saveFig=False, workers=1, raster=False):
         '''
         Creates all mosaic images for a particular date.
-        Images should be approximately 5 minutes apart.
+        Images should be approximately 5 minutes apart.  Only times when at
+        least one site has data are included (see frame_times).
 
         Parameters
         ==========
         date : datetime object
             Date for which mosaic is created.
+        saveFig : boolean, optional
+            Saves figure of each mosaic if set to True.
+        workers : int, optional
+            Number of processes used to create mosaic images.  Defaults to 1.
+        raster : boolean, optional
+            If True, frames are rendered by raster_renderer and written as
+            PNG files directly, instead of drawn with matplotlib.
 
         '''
-        # create time list for night (images should be ~5 minutes apart)
-        # currently this is hard-coded to range from 2-11 UT on the date given
-        # Note - start and end times vary by season and should be determined by the data in some way
-        starttime = dt.datetime.combine(date,dt.time(2,0,0))
-        endtime = dt.datetime.combine(date,dt.time(11,0,0))
-        dtime = 5      # time between frames in minutes
-        num_frames = int((endtime-starttime).total_seconds()/60./dtime)+1
-        time_list = [starttime+dt.timedelta(minutes=i*dtime) for i in range(num_frames)]
+        # frames with images from at least one site, and which sites have them
+        time_list, coverage = self.frame_coverage(date)
 
         # create save directory
         savedir = 'mosaic_images_{:%b%d%y}_gray'.format(date)
         if not os.path.exists(savedir):
             os.mkdir(savedir)
 
-        # create background grid
-        grid, edges = self.generate_grid()
+        renderers = [('gray',100)] if raster and saveFig else []
+        for time in self.map_frames('save_mosaic_frame', [(time, savedir, saveFig, raster, sites) for time, sites in zip(time_list, coverage)],
+                                    workers=workers, renderers=renderers):
+            print(time)
 
-        # find site hierarchy for background grid
-        hierarchy = self.site_hierarchy(grid)
 
-        for time in time_list:
-            print(time)
+    def frame_times(self, date, cadence=5):
+        '''
+        Times of the mosaic frames for a particular date.  Frames are
+        cadence minutes apart and only cover times when at least one site has
+        an image, which is determined from the Time arrays of the data files
+        without reading any images.
 
-            # create mosaic of all sites on background grid
-            mosaic, truetime = self.grid_mosaic(time,grid,hierarchy)
+        Parameters
+        ==========
+        date : datetime object
+            Date of frames.
+        cadence : float, optional
+            Time between frames in minutes.  Defaults to 5.
 
-            # set up map
-            fig = plt.figure(figsize=(13,10))
-            map_proj = ccrs.LambertConformal(central_longitude=255.,central_latitude=40.0)
-            ax = fig.add_subplot(111,projection=map_proj)
-            ax.coastlines()
-            ax.gridlines(color='lightgrey', linestyle='-', draw_labels=True, x_inline = False, y_inline = False)
-            ax.add_feature(cfeature.STATES)
-            ax.set_extent([235,285,20,52])
+        Returns
+        =======
+        time_list : list
+            Times of frames.
 
-            # plot image on map
-            ax.pcolormesh(edges[0], edges[1], mosaic, cmap=plt.get_cmap('gray'),transform=ccrs.PlateCarree())
+        '''
+        time_list, __ = self.frame_coverage(date, cadence)
+        return time_list
+
+
+    def frame_coverage(self, date, cadence=5):
+        '''
+        Mosaic frames for a particular date that at least one site has an
+        image for, and which sites have images for each frame.  Only the Time
+        array of each site's data file is read.
+
+        Parameters
+        ==========
+        date : datetime object
+            Date of frames.
+        cadence : float, optional
+            Time between frames in minutes.  Defaults to 5.
+
+        Returns
+        =======
+        time_list : list
+            Times of frames.
+        coverage : array
+            True where a site (columns, in the order of site_list) has an
+            image for a frame (rows).
+
+        '''
+        if isinstance(date, dt.datetime):
+            date = date.date()
+
+        # times of images of every site on this date
+        site_times = []
+        for site in self.site_list:
+            tstmp = np.empty(0)
+            if self.sites.operational(site,date):
+                filename = self.datafile_name(site,date)
+                try:
+                    if not os.path.exists(filename) and self.download_data:
+                        print('Attempting to download {} from FTP server.'.format(os.path.basename(filename)))
+                        self.fetch_datafile(site,date)
+                    with self._file_lock:
+                        tstmp = self.open_datafile(filename)['time']
+                except (OSError, IOError, ValueError) as e:
+                    print('Exception: {}'.format(str(e)))
+            site_times.append(np.sort(tstmp))
+
+        all_times = np.concatenate(site_times)
+        if not len(all_times):
+            return [], np.zeros((0,len(self.site_list)),dtype=bool)
+
+        # images are used for frames up to 5 minutes away (see read_datafile)
+        tolerance = 5.*60.
+        step = cadence*60.
+        midnight = (dt.datetime.combine(date,dt.time())-dt.datetime.utcfromtimestamp(0)).total_seconds()
+        first = max(np.ceil((all_times.min()-tolerance-midnight)/step),0)
+        last = min(np.floor((all_times.max()+tolerance-midnight)/step),np.ceil(86400./step)-1)
+        frames = midnight+np.arange(first,last+1)*step
+
+        coverage = np.zeros((len(frames),len(self.site_list)),dtype=bool)
+        for i, tstmp in enumerate(site_times):
+            if not len(tstmp):
+                continue
+            # distance from each frame to the closest image of this site
+            t = np.clip(np.searchsorted(tstmp,frames),1,max(len(tstmp)-1,1))
+            closest = np.minimum(np.abs(tstmp[t-1]-frames),np.abs(tstmp[np.minimum(t,len(tstmp)-1)]-frames))
+            coverage[:,i] = closest<=tolerance
+
+        covered = coverage.any(axis=1)
+        time_list = [dt.datetime.utcfromtimestamp(ts) for ts in frames[covered]]
+        return time_list, coverage[covered]
+
+
+    def map_frames(self, method, args_list, workers=1, renderers=()):
+        '''
+        Calls a method of this object once for each frame, in worker processes
+        if workers > 1.  Results are generated in the order of args_list.
+
+        Parameters
+        ==========
+        method : str
+            Name of method.
+        args_list : list
+            Arguments of each call.
+        workers : int, optional
+            Number of processes.  Defaults to 1.
+        renderers : list, optional
+            (cmap, dpi) of raster renderers used by the method, which are
+            created once and shared with the workers.
+
+        Yields
+        ======
+        result
+            Return value of each call.
+
+        '''
+        if workers <= 1:
+            for args in args_list:
+                yield getattr(self,method)(*args)
+            return
+
+        # copy background grid, cell edges and site hierarchy into shared memory once
+        # so worker processes don't each recalculate (or unpickle) them
+        shared = []
+        arrays = {}
+        try:
+            for name in ['grid','edges'] if self.blend else ['grid','edges','hierarchy']:
+                array = getattr(self,name)
+                shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                shared.append(shm)
+                arrays[name] = (shm.name, array.shape, array.dtype.str)
+
+            # workers share the renderers instead of each drawing the map features
+            state = dict(site_list=self.site_list, datadir=self.datadir, download_data=self.download_data,
+                         cache_dir=self.cache.cache_dir, grid_spec=self.grid_spec, grid_key=self.grid_key(self.grid),
+                         dtype=self.dtype, fill_value=self.fill_value, site_file=self.site_file, blend=self.blend,
+                         calibrate=self.calibrate, max_open_files=self.max_open_files, use_memmap=self.use_memmap, arrays=arrays,
+                         renderers={key:self.raster_renderer(*key) for key in renderers})
+
+            with multiprocessing.Pool(workers, initializer=_init_frame_worker, initargs=(state,)) as pool:
+                # imap returns results in order, so progress is reported in time order
+                for result in pool.imap(_frame_worker, [(method, args) for args in args_list]):
+                    yield result
+        finally:
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+
+
+    @instrument.timed('save_mosaic_frame')
+    def save_mosaic_frame(self, time, savedir, saveFig=True, raster=False, sites=None):
+        '''
+        Creates and saves a single frame of create_all_mosaic.
+
+        Parameters
+        ==========
+        time : datetime object
+            Time of images on mosaic as requested by user.
+        savedir : str
+            Directory where the image is saved.
+        saveFig : boolean, optional
+            Saves figure of mosaic if set to True.
+        raster : boolean, optional
+            If True, the frame is rendered by raster_renderer and written as a
+            PNG file directly, with the title and image times stored as PNG
+            text, instead of drawn with matplotlib.
+        sites : array, optional
+            True for sites (in the order of site_list) known to have an image
+            at this time, e.g. a row of frame_coverage; other sites aren't read.
+            Defaults to all sites.
 
-            # add target time as title of plot
-            ax.set_title('{:%Y-%m-%d %H:%M}'.format(time))
+        Returns
+        =======
+        time : datetime object
+            Time of mosaic.
 
-            # print actual image times below plot
-            img_times = ['{} - {:%H:%M:%S}'.format(site['name'],ttime) for site, ttime in zip(self.site_list, truetime) if ttime]
-            img_times = '\n'.join(img_times)
-            ax.text(0.05,-0.03,img_times,verticalalignment='top',transform=ax.transAxes)
+        '''
+        # create mosaic of all sites on background grid
+        mosaic, truetime = self.grid_mosaic(time,self.grid,self.hierarchy,sites)
+        edges = self.edges
 
-            # save image
+        if raster:
             if saveFig:
-                plt.savefig('{}/mosaic_{:%Y%m%d_%H%M}'.format(savedir,time), dpi=300)
+                img_times = ['{} - {:%H:%M:%S}'.format(site['name'],ttime) for site, ttime in zip(self.site_list, truetime) if ttime]
+                write_png('{}/mosaic_{:%Y%m%d_%H%M}.png'.format(savedir,time), self.raster_renderer('gray').render(mosaic),
+                          text={'Title':'{:%Y-%m-%d %H:%M}'.format(time), 'Comment':'\n'.join(img_times)})
+            return time
+
+        import matplotlib.pyplot as plt
+        import cartopy.crs as ccrs
+        import cartopy.feature as cfeature
+
+        # set up map
+        fig = plt.figure(figsize=(13,10))
+        map_proj = ccrs.LambertConformal(central_longitude=self.grid_spec.map_center[1],central_latitude=self.grid_spec.map_center[0])
+        ax = fig.add_subplot(111,projection=map_proj)
+        ax.coastlines()
+        ax.gridlines(color='lightgrey', linestyle='-', draw_labels=True, x_inline = False, y_inline = False)
+        ax.add_feature(cfeature.STATES)
+        ax.set_extent(self.grid_spec.map_extent)
+
+        # plot image on map
+        mosaic = np.ma.masked_where(~valid_data(mosaic,self.fill_value),mosaic)
+        ax.pcolormesh(edges[0], edges[1], mosaic, cmap=plt.get_cmap('gray'),transform=ccrs.PlateCarree())
+
+        # add target time as title of plot
+        ax.set_title('{:%Y-%m-%d %H:%M}'.format(time))
+
+        # print actual image times below plot
+        img_times = ['{} - {:%H:%M:%S}'.format(site['name'],ttime) for site, ttime in zip(self.site_list, truetime) if ttime]
+        img_times = '\n'.join(img_times)
+        ax.text(0.05,-0.03,img_times,verticalalignment='top',transform=ax.transAxes)
+
+        # save image
+        if saveFig:
+            fig.savefig('{}/mosaic_{:%Y%m%d_%H%M}'.format(savedir,time), dpi=300)
+
+        # close figure so memory doesn't grow over the night
+        plt.close(fig)
 
+        return time
 
-    def create_mosaic_movie(self,date):
+
+    @instrument.timed('render_frame')
+    def render_frame(self, time, cmap='gray', sites=None):
+        '''
+        Creates a mosaic and renders it with raster_renderer.
+
+        Parameters
+        ==========
+        time : datetime object
+            Time of images on mosaic as requested by user.
+        cmap : str, optional
+            Name of matplotlib colormap.
+        sites : array, optional
+            True for sites (in the order of site_list) known to have an image
+            at this time, e.g. a row of frame_coverage; other sites aren't read.
+            Defaults to all sites.
+
+        Returns
+        =======
+        rgb : array
+            RGB image (rows, cols, 3) of the map.
+
+        '''
+        mosaic, __ = self.grid_mosaic(time,self.grid,self.hierarchy,sites)
+        return self.raster_renderer(cmap).render(mosaic)
+
+
+    @instrument.timed('create_mosaic_movie')
+    def create_mosaic_movie(self,date,workers=1,framerate=5,filename=None,cmap='gray'):
         '''
         Creates a movie of all mosaic images for particular date.
-        Requires ffmpeg to be installed.
+        Requires ffmpeg to be installed.  Frames are rendered with
+        raster_renderer and piped to ffmpeg as raw RGB images, so no image
+        files are written.
 
         Parameters
         ==========
         date : datetime object
             Date for which mosaic movie is created.
+        workers : int, optional
+            Number of processes rendering frames.  Frames are always encoded
+            in time order.  Defaults to 1.
+        framerate : float, optional
+            Frames per second of movie.  Defaults to 5.
+        filename : str, optional
+            Movie filename.  Defaults to mosaic_movie_MMMDDYY.mp4.
+        cmap : str, optional
+            Name of matplotlib colormap.
+
+        Raises
+        ======
+        ValueError
+            If no site has images on this date.
 
         '''
-        # create *.png image files for the given date
-        self.create_all_mosaic(date)
-
-        # combine image files into mp4 using ffmpeg
-        ffmpeg_command = "ffmpeg -f image2 -r 5 -pattern_type glob -i 'mosaic_images_{:%b%d%y}/*.png' mosaic_movie_{:%b%d%y}.mp4".format(date,date)
-        os.system(ffmpeg_command)
+        if filename is None:
+            filename = 'mosaic_movie_{:%b%d%y}.mp4'.format(date)
+
+        # frames with images from at least one site, found before starting ffmpeg
+        time_list, coverage = self.frame_coverage(date)
+        if not time_list:
+            raise ValueError('No data available for {:%Y-%m-%d}.'.format(date))
+
+        rows, cols = self.raster_renderer(cmap).shape
+        # most codecs need an even number of rows and columns
+        ffmpeg_command = ['ffmpeg', '-y', '-loglevel', 'error',
+                          '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(cols,rows), '-r', str(framerate), '-i', '-',
+                          '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', filename]
+        ffmpeg = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+
+        frames = self.map_frames('render_frame', [(time, cmap, sites) for time, sites in zip(time_list, coverage)],
+                                 workers=workers, renderers=[(cmap,100)])
+        try:
+            for time, rgb in zip(time_list, frames):
+                print(time)
+                ffmpeg.stdin.write(np.ascontiguousarray(rgb).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early; its error is reported below
+            pass
+        finally:
+            # stop any worker processes and release shared memory
+            frames.close()
+            try:
+                ffmpeg.stdin.close()
+            except BrokenPipeError:
+                pass
+            ffmpeg.wait()
+
+        if ffmpeg.returncode != 0:
+            raise RuntimeError('ffmpeg failed to create {} (exit status {})'.format(filename, ffmpeg.returncode))
+
+
+# state of create_all_mosaic worker processes
+_worker_mosaic = None
+_worker_shared = []
+
+def _init_frame_worker(state):
+    # set up a Mosaic object in a worker process using the parent's shared arrays
+    global _worker_mosaic
+    # workers never show figures
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].switch_backend('Agg')
+    else:
+        os.environ['MPLBACKEND'] = 'Agg'
+    m = Mosaic(datadir=state['datadir'], cache_dir=state['cache_dir'], grid_spec=state['grid_spec'],
+               dtype=state['dtype'], fill_value=state['fill_value'], site_file=state['site_file'], blend=state['blend'],
+               calibrate=state['calibrate'], download_data=state['download_data'], max_open_files=state['max_open_files'],
+               use_memmap=state['use_memmap'])
+    m.site_list = state['site_list']
+    for name, (shm_name, shape, dtype) in state['arrays'].items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_shared.append(shm)
+        setattr(m, '_'+name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    m._grid_key = (m._grid, state['grid_key'])
+    m._renderers = state['renderers']
+    _worker_mosaic = m
+
+def _frame_worker(args):
+    # create a single frame in a worker process
+    method, args = args
+    return getattr(_worker_mosaic, method)(*args)
 
 
 def main():
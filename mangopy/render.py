@@ -0,0 +1,195 @@
+# render.py
+# fast raster rendering of mosaics
+#
+# Notes:
+# - the mapping from map pixels to background grid cells is calculated once, so
+#   rendering a frame is a single gather from the mosaic followed by a colormap lookup
+# - coastlines, state borders and gridlines are drawn once with cartopy into a transparent
+#   layer that is composited over every frame
+# - frames are written as PNG files directly (zlib), without creating matplotlib figures
+# - matplotlib and cartopy are only imported when a renderer is created
+
+import numpy as np
+import struct
+import zlib
+from .export import valid_data
+
+
+class RasterRenderer(object):
+    """
+    Renders mosaics on the background grid to RGB images of a Lambert
+    conformal map, the same view as Mosaic.plot_mosaic.
+
+    Parameters
+    ==========
+    grid_spec : GridSpec
+        Background grid of the mosaics, including the map center and extent.
+    cmap : str, optional
+        Name of matplotlib colormap.
+    vmin : float, optional
+        Value shown with the lowest color.  Defaults to the minimum of each frame.
+    vmax : float, optional
+        Value shown with the highest color.  Defaults to the maximum of each frame.
+    figsize : tuple, optional
+        Size of map (inches).
+    dpi : int, optional
+        Resolution of map (pixels per inch).
+    fill_value : float, optional
+        Value of mosaic cells without data.
+
+    """
+
+    def __init__(self, grid_spec, cmap='gray', vmin=None, vmax=None, figsize=(13,10), dpi=100, fill_value=np.nan):
+
+        self.grid_spec = grid_spec
+        self.vmin = vmin
+        self.vmax = vmax
+        self.fill_value = fill_value
+        self.background = np.array([255,255,255], dtype=np.uint8)
+
+        import matplotlib.pyplot as plt
+
+        # colormap as a lookup table of 256 colors
+        self.colors = (plt.get_cmap(cmap)(np.linspace(0.,1.,256))[:,:3]*255.).round().astype(np.uint8)
+
+        self.render_basemap(figsize, dpi)
+
+        # grid cell shown in every map pixel
+        index = grid_spec.locate(self.pixel_lat, self.pixel_lon).ravel()
+        self.pixels = np.flatnonzero(index>=0)
+        self.cells = index[self.pixels]
+        del self.pixel_lat, self.pixel_lon
+
+    def render_basemap(self, figsize, dpi):
+        """
+        Draws coastlines, state borders and gridlines into a transparent layer
+        and calculates the coordinates of every map pixel.
+
+        Parameters
+        ==========
+        figsize : tuple
+            Size of map (inches).
+        dpi : int
+            Resolution of map (pixels per inch).
+
+        """
+        import matplotlib.pyplot as plt
+        import cartopy.crs as ccrs
+        import cartopy.feature as cfeature
+
+        map_center = self.grid_spec.map_center
+        map_proj = ccrs.LambertConformal(central_longitude=map_center[1],central_latitude=map_center[0])
+
+        fig = plt.figure(figsize=figsize, dpi=dpi)
+        fig.patch.set_alpha(0.)
+        ax = fig.add_axes([0.,0.,1.,1.], projection=map_proj)
+        ax.patch.set_alpha(0.)
+        ax.coastlines()
+        ax.gridlines(color='lightgrey', linestyle='-')
+        ax.add_feature(cfeature.STATES)
+        ax.set_extent(self.grid_spec.map_extent)
+        fig.canvas.draw()
+
+        # crop to the map itself, which keeps the aspect ratio of the extent
+        layer = np.asarray(fig.canvas.buffer_rgba())
+        bbox = ax.get_window_extent()
+        top = int(round(layer.shape[0]-bbox.y1))
+        bottom = int(round(layer.shape[0]-bbox.y0))
+        left = int(round(bbox.x0))
+        right = int(round(bbox.x1))
+        layer = layer[top:bottom,left:right]
+        xlim = ax.get_xlim()
+        ylim = ax.get_ylim()
+        plt.close(fig)
+
+        self.shape = layer.shape[:2]
+
+        # keep only the pixels the layer draws on, premultiplied by their opacity
+        alpha = layer[:,:,3].ravel()/255.
+        self.overlay = np.flatnonzero(alpha>0.)
+        self.overlay_alpha = alpha[self.overlay,None].astype(np.float32)
+        self.overlay_color = (layer[:,:,:3].reshape(-1,3)[self.overlay]*self.overlay_alpha).astype(np.float32)
+
+        # map coordinates of pixel centers, from the top left corner
+        x = xlim[0]+(np.arange(self.shape[1])+0.5)/self.shape[1]*(xlim[1]-xlim[0])
+        y = ylim[1]-(np.arange(self.shape[0])+0.5)/self.shape[0]*(ylim[1]-ylim[0])
+        x, y = np.meshgrid(x, y)
+        lonlat = ccrs.PlateCarree().transform_points(map_proj, x, y)
+        self.pixel_lon = lonlat[:,:,0]
+        self.pixel_lat = lonlat[:,:,1]
+
+    def render(self, img, vmin=None, vmax=None):
+        """
+        Renders a mosaic.
+
+        Parameters
+        ==========
+        img : array
+            Mosaic on the background grid.
+        vmin : float, optional
+            Value shown with the lowest color.
+        vmax : float, optional
+            Value shown with the highest color.
+
+        Returns
+        =======
+        rgb : array
+            RGB image (rows, cols, 3) of the map.
+
+        """
+        values = np.asarray(img).ravel()[self.cells]
+        valid = valid_data(values,self.fill_value)
+
+        # like pcolormesh, scale colors to the range of each frame unless limits are given
+        vmin = vmin if vmin is not None else self.vmin
+        vmax = vmax if vmax is not None else self.vmax
+        if vmin is None:
+            vmin = values[valid].min() if valid.any() else 0.
+        if vmax is None:
+            vmax = values[valid].max() if valid.any() else 1.
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            level = (values-np.float32(vmin))*np.float32(255./(vmax-vmin)) if vmax > vmin else np.zeros(values.shape)
+        level = np.clip(np.nan_to_num(level), 0, 255).astype(np.uint8)
+
+        rgb = np.empty((self.shape[0]*self.shape[1],3), dtype=np.uint8)
+        rgb[:] = self.background
+        rgb[self.pixels[valid]] = self.colors[level[valid]]
+
+        # composite coastlines, borders and gridlines
+        rgb[self.overlay] = (rgb[self.overlay]*(1.-self.overlay_alpha)+self.overlay_color).round().astype(np.uint8)
+
+        return rgb.reshape(self.shape+(3,))
+
+
+def write_png(filename, rgb, text=None, level=1):
+    """
+    Writes an RGB image to a PNG file.
+
+    Parameters
+    ==========
+    filename : str
+        PNG filename.
+    rgb : array
+        RGB image (rows, cols, 3) of type uint8.
+    text : dict, optional
+        Text (e.g. title and image times) stored in the file as tEXt chunks.
+    level : int, optional
+        zlib compression level.
+
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data))+kind+data+struct.pack('>I', zlib.crc32(kind+data) & 0xffffffff)
+
+    rows, cols = rgb.shape[:2]
+    # every row starts with filter type 0 (none)
+    raw = np.zeros((rows,cols*3+1), dtype=np.uint8)
+    raw[:,1:] = rgb.reshape(rows,cols*3)
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, 2, 0, 0, 0)))
+        for key, value in (text or {}).items():
+            f.write(chunk(b'tEXt', '{}\x00{}'.format(key, value).encode('latin-1', 'replace')))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), level)))
+        f.write(chunk(b'IEND', b''))
@@ -0,0 +1,195 @@
+# sites.py
+# registry of MANGO camera sites
+#
+# Notes:
+# - site files are csv files with the columns of SiteInformation.csv (Site Name, Site Abbreviation,
+#   Center Longitude, Center Latitude) and optionally Start Date and End Date (YYYY-MM-DD) of
+#   operation; empty dates mean the site was operating from the start or is still operating
+# - a user site file (the site_file argument or the MANGOPY_SITE_FILE environment variable)
+#   adds sites to SiteInformation.csv, replacing sites with the same name
+# - registries are only read once per process for each combination of site files
+
+import numpy as np
+import datetime as dt
+import csv
+import os
+import threading
+
+
+class SiteRegistry(object):
+    """
+    Sites of the MANGO network, indexed by name and code.
+
+    Parameters
+    ==========
+    site_list : list
+        List of dictionaries with information about sites.
+
+    """
+
+    _loaded = {}
+    _lock = threading.Lock()
+
+    def __init__(self, site_list):
+
+        self.site_list = list(site_list)
+        self.names = [site['name'] for site in self.site_list]
+        self.codes = [site['code'] for site in self.site_list]
+        self.lat = np.array([site['lat'] for site in self.site_list])
+        self.lon = np.array([site['lon'] for site in self.site_list])
+
+        self._index = {}
+        for i, site in enumerate(self.site_list):
+            self._index.setdefault(site['code'], i)
+        # names take precedence over codes
+        self._index.update((name, i) for i, name in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.site_list)
+
+    def __iter__(self):
+        return iter(self.site_list)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        try:
+            return dict(self.site_list[self._index[key]])
+        except KeyError:
+            raise KeyError('Unknown MANGO site {}'.format(key)) from None
+
+    @classmethod
+    def load(cls, site_file=None):
+        """
+        Registry of the sites in SiteInformation.csv and an optional user
+        site file.  Each combination of site files is only read once.
+
+        Parameters
+        ==========
+        site_file : str, optional
+            User site file.  Defaults to the MANGOPY_SITE_FILE environment
+            variable, if it is set.
+
+        Returns
+        =======
+        registry : SiteRegistry
+            Site registry.
+
+        """
+        if site_file is None:
+            site_file = os.environ.get('MANGOPY_SITE_FILE')
+        sitefiles = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'SiteInformation.csv')]
+        if site_file:
+            sitefiles.append(os.path.abspath(site_file))
+
+        key = tuple(sitefiles)
+        with cls._lock:
+            if key not in cls._loaded:
+                sites = {}
+                for sitefile in sitefiles:
+                    for site in cls.read_sitefile(sitefile):
+                        sites[site['name']] = site
+                cls._loaded[key] = cls(sites.values())
+            return cls._loaded[key]
+
+    @staticmethod
+    def read_sitefile(sitefile):
+        """
+        Reads sites from a site file.
+
+        Parameters
+        ==========
+        sitefile : str
+            csv site file.
+
+        Returns
+        =======
+        site_list : list
+            List of dictionaries with information about sites.
+
+        """
+        def date(value):
+            return dt.datetime.strptime(value.strip(),'%Y-%m-%d').date() if value and value.strip() else None
+
+        site_list = []
+        with open(sitefile,'r') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                site = {'name':row['Site Name'],'code':row['Site Abbreviation'],
+                        'lon':float(row['Center Longitude']),'lat':float(row['Center Latitude'])}
+                if row.get('Start Date') or row.get('End Date'):
+                    site['start'] = date(row.get('Start Date'))
+                    site['end'] = date(row.get('End Date'))
+                site_list.append(site)
+        return site_list
+
+    def select(self, sites='all'):
+        """
+        Sites given as user input.
+
+        Parameters
+        ==========
+        sites : list or str, optional
+            Site names or codes, or 'all' for all sites.
+
+        Returns
+        =======
+        site_list : list
+            List of dictionaries with information about sites, in the order
+            of the registry.  Unknown sites are left out.
+
+        """
+        if sites == 'all':
+            selected = range(len(self.site_list))
+        else:
+            if isinstance(sites, str):
+                sites = [sites]
+            selected = sorted({self._index[site] for site in sites if site in self._index})
+        # copies, so callers can't change the registry shared by the process
+        return [dict(self.site_list[i]) for i in selected]
+
+    @staticmethod
+    def coordinates(site_list):
+        """
+        Latitude and longitude of several sites as arrays.
+
+        Parameters
+        ==========
+        site_list : list
+            List of dictionaries with information about sites.
+
+        Returns
+        =======
+        lat : array
+            Site latitudes.
+        lon : array
+            Site longitudes.
+
+        """
+        return np.array([site['lat'] for site in site_list]), np.array([site['lon'] for site in site_list])
+
+    @staticmethod
+    def operational(site, date):
+        """
+        Whether a site was operating on a date, according to its start and end
+        dates.  Sites without dates are always assumed to be operating.
+
+        Parameters
+        ==========
+        site : dict
+            Site information.
+        date : datetime object
+            Date (or time).
+
+        Returns
+        =======
+        operational : bool
+            False if the date is outside the operating dates of the site.
+
+        """
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        start = site.get('start')
+        end = site.get('end')
+        return (start is None or date >= start) and (end is None or date <= end)
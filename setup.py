@@ -2,7 +2,7 @@ from setuptools import setup
 import os
 
 REQUIREMENTS = [
-    'scipy >= 1.2',
+    'scipy >= 1.6',
     'h5py >= 2.9',
     'matplotlib >= 2.2.4'
 ]
@@ -20,4 +20,5 @@ setup(name='mangopy',
       packages=['mangopy'],
       install_requires=REQUIREMENTS,
       package_data={'mangopy': ['SiteInformation.csv']},
+      python_requires='>=3.8',
       zip_safe=False)